@@ -0,0 +1,263 @@
+"""
+Micro-benchmarks of the correction boluses handlers and of their hot-path helpers on synthetic 1, 7 and 30 day traces.
+The handlers are driven through the same one-minute step loop used by ReplayBG, with a stub DSS object (see
+src.advisor), so that ReplayBG is not needed. Results are saved as JSON files that can be compared between versions (see compare_benchmarks).
+
+Usage:
+    python -m benchmarks.handlers
+"""
+
+import os
+import sys
+import json
+import time
+import pickle
+import platform
+import datetime
+import tempfile
+import subprocess
+
+import numpy as np
+import pandas as pd
+
+from src.handlers import standard_cib, aleppo, drCORRECT, compute_iob, get_last_mealtime
+from src.strategies import aleppo_params, drcorrect_params
+from src.utils import retrieve_t_pers
+from src.advisor import StubDSS
+
+
+# Subject used by the synthetic traces
+SUBJECT_INFO = {'cf': 40, 'gt': 120, 'cr': 10, 'bw': 70, 'u2ss': 1.2}
+T_PERS = 120
+
+# Meals of a synthetic day: (label, minute of the day, CHO in g, whether a meal bolus is taken)
+MEALS = [('B', 7*60 + 30, 50, True), ('L', 13*60, 70, True), ('S', 16*60 + 30, 20, False), ('D', 20*60, 80, True)]
+
+# Handlers benchmarked: name -> (handler, params builder of the correction boluses handler)
+HANDLERS = {
+    'standard_cib': (standard_cib, lambda subject_info, t_pers: {}),
+    'aleppo': (aleppo, aleppo_params),
+    'drCORRECT': (drCORRECT, drcorrect_params),
+}
+
+
+def synthetic_trace(n_days: int, seed: int = 1) -> dict:
+    """
+    Build a synthetic trace with one-minute resolution (the resolution of the ReplayBG simulation).
+    Each day has breakfast, lunch, snack and dinner at jittered times, meal boluses from the carbohydrate ratio
+    (none for the snack) and a glucose response to each meal on top of a slow oscillation and noise.
+    Args:
+        n_days: int, length of the trace in days
+        seed: int, seed of the random generator
+    Returns:
+        trace: dict, with the handler inputs 'glucose', 'meal_announcement', 'meal_type', 'hypotreatments',
+            'bolus', 'basal' and 'time'
+    """
+    rng = np.random.default_rng(seed)
+    n = n_days * 1440
+
+    meal_announcement = np.zeros(n)
+    meal_type = np.full(n, '', dtype='<U1')
+    bolus = np.zeros(n)
+    for day in range(n_days):
+        for label, minute, cho, with_bolus in MEALS:
+            t = day * 1440 + minute + int(rng.integers(-30, 31))
+            meal_announcement[t] = cho * rng.uniform(0.8, 1.2)
+            meal_type[t] = label
+            if with_bolus:
+                bolus[t] = meal_announcement[t] / SUBJECT_INFO['cr']
+
+    # meal responses peaking 60 min after the meal, about 2 mg/dl per g
+    kernel_t = np.arange(300)
+    kernel = 2 * (kernel_t / 60) * np.exp(1 - kernel_t / 60)
+    minutes = np.arange(n)
+    glucose = (120 + np.convolve(meal_announcement, kernel)[:n]
+               + 20 * np.sin(2 * np.pi * minutes / 1440) + rng.normal(0, 3, n))
+
+    return {'glucose': np.clip(glucose, 40, 400),
+            'meal_announcement': meal_announcement,
+            'meal_type': meal_type,
+            'hypotreatments': np.zeros(n),
+            'bolus': bolus,
+            'basal': np.full(n, SUBJECT_INFO['u2ss'] * SUBJECT_INFO['bw'] / 1000),
+            'time': np.datetime64('2018-07-05T00:00') + minutes.astype('timedelta64[m]')}
+
+
+def simulate_handler(handler: object, trace: dict, params: dict) -> tuple[np.ndarray, float]:
+    """
+    Call a handler at every step of a trace, as ReplayBG does, adding its correction boluses to the bolus input
+    at the next step.
+    Args:
+        handler: function, correction boluses handler
+        trace: dict, synthetic trace (see synthetic_trace)
+        params: dict, parameters of the handler
+    Returns:
+        latencies: np.ndarray, duration of each call (ns)
+        total_cb: float, total correction insulin (U), a checksum of the handler decisions
+    """
+    dss = StubDSS({'cf': SUBJECT_INFO['cf'], 'gt': SUBJECT_INFO['gt']}, dict(params))
+    bolus = trace['bolus'].copy()
+    n = bolus.size
+    latencies = np.empty(n, dtype=np.int64)
+    total_cb = 0.
+    for time_index in range(n):
+        tic = time.perf_counter_ns()
+        cb, dss = handler(trace['glucose'], trace['meal_announcement'], trace['meal_type'], trace['hypotreatments'],
+                          bolus, trace['basal'], trace['time'], time_index, dss)
+        latencies[time_index] = time.perf_counter_ns() - tic
+        if time_index + 1 < n:
+            bolus[time_index + 1] += cb
+        total_cb += cb
+    return latencies, float(total_cb)
+
+
+def simulate_step_function(name: str, trace: dict) -> np.ndarray:
+    """
+    Call a helper of the handlers (compute_iob or get_last_mealtime) at every step of a trace but the first
+    (as the handlers do, that never call them on an empty history).
+    Returns:
+        latencies: np.ndarray, duration of each call (ns)
+    """
+    bolus, meal_announcement, meal_type = trace['bolus'], trace['meal_announcement'], trace['meal_type']
+    n = bolus.size
+    latencies = np.empty(n - 1, dtype=np.int64)
+    for time_index in range(1, n):
+        tic = time.perf_counter_ns()
+        if name == 'compute_iob':
+            compute_iob(bolus[:time_index])
+        else:
+            get_last_mealtime(meal_announcement, meal_type, time_index)
+        latencies[time_index - 1] = time.perf_counter_ns() - tic
+    return latencies
+
+
+def summarize(name: str, days: int | None, latencies: list[np.ndarray], total_cb: float = np.nan) -> dict:
+    """
+    Summary of the repeated runs of a benchmark: total time of the fastest run and per-call latency over all the runs.
+    """
+    all_latencies = np.concatenate(latencies) / 1e3
+    return {'benchmark': name,
+            'days': days,
+            'calls': int(latencies[0].size),
+            'repeats': len(latencies),
+            'total_s': float(min(l.sum() for l in latencies) / 1e9),
+            'call_mean_us': float(all_latencies.mean()),
+            'call_median_us': float(np.median(all_latencies)),
+            'call_p95_us': float(np.percentile(all_latencies, 95)),
+            'call_max_us': float(all_latencies.max()),
+            'total_cb': total_cb}
+
+
+def bench_retrieve_t_pers(repeats: int = 20, seed: int = 1) -> list[dict]:
+    """
+    Benchmark retrieve_t_pers on synthetic map and MCMC twins ('first' and 'median' statistics).
+    """
+    rng = np.random.default_rng(seed)
+    draws = {'ka2': rng.lognormal(np.log(0.014), 0.2, 1000), 'kd': rng.lognormal(np.log(0.026), 0.2, 1000)}
+
+    rows = []
+    with tempfile.TemporaryDirectory() as save_folder:
+        for method in ['map', 'mcmc']:
+            os.makedirs(os.path.join(save_folder, "results", method))
+        pd.to_pickle({'draws': {p: float(v[0]) for p, v in draws.items()}},
+                     os.path.join(save_folder, "results", "map", "map_benchmark.pkl"))
+        with open(os.path.join(save_folder, "results", "mcmc", "mcmc_benchmark.pkl"), 'wb') as f:
+            pickle.dump({'draws': {p: {f'samples_{k}': v[:k] for k in [1, 10, 100, 1000]} for p, v in draws.items()}}, f)
+
+        for method, statistic in [('map', 'first'), ('mcmc', 'first'), ('mcmc', 'median')]:
+            latencies = np.empty(repeats, dtype=np.int64)
+            for i in range(repeats):
+                tic = time.perf_counter_ns()
+                retrieve_t_pers("benchmark", SUBJECT_INFO, save_folder, method, statistic)
+                latencies[i] = time.perf_counter_ns() - tic
+            rows.append(summarize(f'retrieve_t_pers[{method}, {statistic}]', None, [latencies]))
+    return rows
+
+
+def run_benchmarks(days: list[int] = (1, 7, 30), repeats: int = 3, output_folder: str | None = "results/benchmarks",
+                   seed: int = 1) -> pd.DataFrame:
+    """
+    Run the benchmark suite and save it as <output_folder>/handlers_<timestamp>.json.
+    Args:
+        days: list, lengths of the synthetic traces in days
+        repeats: int, runs of each benchmark on each trace
+        output_folder: str, folder of the results (None to not save them)
+        seed: int, seed of the synthetic traces
+    Returns:
+        results: pd.DataFrame, one row per benchmark and trace length, with the total time of the fastest run,
+            the per-call latency statistics (us) and, for the handlers, the total correction insulin
+    """
+    rows = []
+    for n_days in days:
+        trace = synthetic_trace(n_days, seed)
+        for name, (handler, params_builder) in HANDLERS.items():
+            params = params_builder(SUBJECT_INFO, T_PERS)
+            runs = [simulate_handler(handler, trace, params) for _ in range(repeats)]
+            rows.append(summarize(name, n_days, [latencies for latencies, _ in runs], runs[0][1]))
+            print(f"{name} on {n_days} days: {rows[-1]['total_s']:0.3f} s, {rows[-1]['call_median_us']:0.2f} us per step.")
+        for name in ['compute_iob', 'get_last_mealtime']:
+            rows.append(summarize(name, n_days, [simulate_step_function(name, trace) for _ in range(repeats)]))
+            print(f"{name} on {n_days} days: {rows[-1]['total_s']:0.3f} s, {rows[-1]['call_median_us']:0.2f} us per step.")
+    rows.extend(bench_retrieve_t_pers())
+    results = pd.DataFrame(rows)
+
+    if output_folder is not None:
+        now = datetime.datetime.now()
+        meta = {'timestamp': now.isoformat(timespec='seconds'),
+                'commit': _git_commit(),
+                'python': sys.version.split()[0],
+                'numpy': np.__version__,
+                'platform': platform.platform(),
+                'repeats': repeats,
+                'seed': seed}
+        os.makedirs(output_folder, exist_ok=True)
+        path = os.path.join(output_folder, f"handlers_{now:%Y%m%d_%H%M%S}.json")
+        with open(path, 'w') as f:
+            json.dump({'meta': meta, 'results': results.replace({np.nan: None}).to_dict('records')}, f, indent=2)
+        print(f"Benchmark results saved in {path}.")
+    return results
+
+
+def load_benchmark(path: str) -> tuple[dict, pd.DataFrame]:
+    """
+    Load results saved by run_benchmarks.
+    Returns:
+        meta: dict, environment of the run (timestamp, commit, python and numpy versions, platform, ...)
+        results: pd.DataFrame, benchmark results
+    """
+    with open(path) as f:
+        payload = json.load(f)
+    return payload['meta'], pd.DataFrame(payload['results'])
+
+
+def compare_benchmarks(baseline_path: str, current_path: str, metric: str = 'call_median_us', threshold: float = 1.2) -> pd.DataFrame:
+    """
+    Compare two benchmark runs.
+    Args:
+        baseline_path: str, results of the reference version
+        current_path: str, results of the version under test
+        metric: str, column compared between the runs
+        threshold: float, current/baseline ratio above which a benchmark is flagged as a regression
+    Returns:
+        comparison: pd.DataFrame, with the metric of both runs, their ratio, a 'regression' flag and a 'changed'
+            flag for handlers whose total correction insulin differs (i.e., whose decisions changed)
+    """
+    _, baseline = load_benchmark(baseline_path)
+    _, current = load_benchmark(current_path)
+    comparison = baseline.merge(current, on=['benchmark', 'days'], how='outer', suffixes=('_baseline', '_current'))
+    comparison['ratio'] = comparison[f'{metric}_current'] / comparison[f'{metric}_baseline']
+    comparison['regression'] = comparison['ratio'] > threshold
+    comparison['changed'] = ~np.isclose(comparison['total_cb_baseline'].astype(float), comparison['total_cb_current'].astype(float),
+                                        equal_nan=True)
+    return comparison[['benchmark', 'days', f'{metric}_baseline', f'{metric}_current', 'ratio', 'regression', 'changed']]
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    print(run_benchmarks().to_string(index=False))
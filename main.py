@@ -8,23 +8,33 @@ from py_replay_bg.py_replay_bg import ReplayBG
 
 from src.visualization import plot_original_data, plot_twinned_data, plot_comparison
 from src.twinning import twin_day
-from src.utils import load_example_data, load_subject_info, retrieve_t_pers, save_comparison
+from src.utils import load_trace, retrieve_t_pers, save_comparison
 from src.analysis import compare_corrective_strategies
+from src.cache import ReplayCache
+from src.profiling import enable_instrumentation, stage
 
 
-def main(twin: bool = False, twinning_method: str = 'map', do_plot: bool = False):
+def main(twin: bool = False, twinning_method: str = 'map', do_plot: bool = False, t_pers_statistic: str = 'first', use_cache: bool = False,
+         timings_path: str | None = None, profile_dir: str | None = None, n_replay: int = 1, n_chunks: int = 1,
+         split_days: bool = False):
+    # 0. Optional instrumentation (JSON lines timings and cProfile stats of the handlers)
+    if timings_path is not None:
+        enable_instrumentation(timings_path, profile_dir)
+    
     # 1. Load original data and set save_name
     trace_name = '0a1f30_05-07-2018'
-    original_data = load_example_data(trace_name)
-    subject_info = load_subject_info(trace_name)
+    with stage('load', trace=trace_name):
+        original_data, subject_info = load_trace(trace_name)
     save_name = "cib_comparison_tidepool_" + trace_name
     save_folder=os.path.abspath("")
+    cache = ReplayCache(os.path.join(save_folder, "results", "cache")) if use_cache else None
 
     if do_plot:
         plot_folder = os.path.abspath("plots")
         if not os.path.exists(plot_folder):
             os.makedirs(plot_folder)
-        plot_original_data(original_data, plot_folder, trace_name)
+        with stage('plot', trace=trace_name, plot='original'):
+            plot_original_data(original_data, plot_folder, trace_name)
 
     # 2. Instantiate ReplayBG digital twinning tool
     rbg = ReplayBG(
@@ -36,19 +46,29 @@ def main(twin: bool = False, twinning_method: str = 'map', do_plot: bool = False
 
     # 3. Optional twinning
     if twin:
-        twin_day(rbg, twinning_method, original_data, subject_info, save_name, trace_name)
+        with stage('twin', trace=trace_name, twinning_method=twinning_method):
+            twin_day(rbg, twinning_method, original_data, subject_info, save_name, trace_name)
     if do_plot:
-        plot_twinned_data(rbg, twinning_method, original_data, subject_info, save_name, plot_folder, trace_name)
+        with stage('plot', trace=trace_name, plot='twinned'):
+            plot_twinned_data(rbg, twinning_method, original_data, subject_info, save_name, plot_folder, trace_name, cache, n_replay)
         
     # 4. Retrieve personal parameters for drCORRECT
-    t_pers = retrieve_t_pers(save_name, subject_info, save_folder, twinning_method)
+    with stage('t_pers', trace=trace_name):
+        t_pers = retrieve_t_pers(save_name, subject_info, save_folder, twinning_method, t_pers_statistic)
     
-    # 5. Compare corrective strategies
-    results = compare_corrective_strategies(rbg, original_data, subject_info, t_pers, twinning_method, save_name, trace_name)
-    save_comparison(results, os.path.join(save_folder, "results", "comparison_results"), trace_name, twinning_method)
+    # 5. Compare corrective strategies (over n_replay posterior draws of MCMC twins, in n_chunks parallel chunks,
+    #    and day by day if split_days for multi-day traces: each day starts from the initial state of the twin and
+    #    the minutes between days have no simulated glucose, see compare_corrective_strategies)
+    with stage('compare', trace=trace_name, n_replay=n_replay):
+        results = compare_corrective_strategies(rbg, original_data, subject_info, t_pers, twinning_method, save_name, trace_name, cache=cache,
+                                                executor=None if n_chunks == 1 and not split_days else 'process',
+                                                n_replay=n_replay, n_chunks=n_chunks, split_days=split_days)
+    with stage('metrics', trace=trace_name):
+        save_comparison(results, os.path.join(save_folder, "results", "comparison_results"), trace_name, twinning_method)
     
     if do_plot:
-        plot_comparison(results, plot_folder, trace_name, twinning_method)
+        with stage('plot', trace=trace_name, plot='comparison'):
+            plot_comparison(results, plot_folder, trace_name, twinning_method)
     
 
 if __name__ == "__main__":
@@ -1,5 +1,14 @@
-from .twinning import twin_day
-from .handlers import drCORRECT
-from .analysis import compare_corrective_strategies
-from .utils import load_example_data, load_subject_info, retrieve_t_pers, save_comparison
-from .visualization import plot_original_data, plot_twinned_data, plot_comparison
+from .twinning import twin_day, twin_cohort
+from .handlers import drCORRECT, get_arrows, score_trends
+from .analysis import compare_corrective_strategies, split_twin, remove_split_twin, merge_realizations, day_segments, stitch_days
+from .utils import load_trace, load_example_data, load_subject_info, retrieve_t_pers, retrieve_t_pers_distribution, save_comparison, realization_metrics
+from .visualization import plot_original_data, plot_twinned_data, plot_comparison, original_data_template, comparison_template
+from .batch import run_batch, discover_traces
+from .strategies import register_strategy, unregister_strategy, build_strategies, STRATEGIES
+from .sweep import sweep_drcorrect, drcorrect_grid
+from .store import append_results, load_results, compact_results
+from .workspace import save_replay, load_replay
+from .cache import ReplayCache
+from .profiling import enable_instrumentation, disable_instrumentation, stage
+from .advisor import advise, advise_archive
+from .streaming import StreamingAdvisor, AdvisorService, replay_traces
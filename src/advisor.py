@@ -0,0 +1,203 @@
+"""
+Open-loop advisor: run the correction boluses handlers directly over recorded data, without twin and without ReplayBG,
+to screen large archives for the correction boluses each strategy would have suggested.
+"""
+
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from src.handlers import standard_cib
+from src.strategies import STRATEGIES, build_strategies
+from src.analysis import remove_correction_boluses
+from src.utils import load_trace
+from src.batch import discover_traces
+
+
+# Settings shared by the worker processes of advise_archive (set once by _init_worker)
+_worker_config = {}
+
+
+class StubDSS:
+    """
+    Minimal stand-in for the ReplayBG DSS object passed to the correction boluses handlers.
+    """
+
+    def __init__(self, bolus_calculator_handler_params: dict, correction_boluses_handler_params: dict):
+        self.bolus_calculator_handler_params = bolus_calculator_handler_params
+        self.correction_boluses_handler_params = correction_boluses_handler_params
+
+
+def advisor_handlers(subject_info: dict, t_pers: float = 120, names: list[str] | None = None) -> dict:
+    """
+    Handlers run by the advisor: the registered strategies with a handler (see src.strategies) and the standard therapy.
+    Args:
+        subject_info: dict, subject information
+        t_pers: float, personalized parameter for drCORRECT
+        names: list, names of the handlers to run (default: all)
+    Returns:
+        handlers: dict, name -> (handler, correction_boluses_handler_params)
+    """
+    handlers = {'Standard therapy': (standard_cib, {})}
+    for strategy in build_strategies(subject_info, t_pers, 'open_loop', [name for name in STRATEGIES if STRATEGIES[name]['handler'] is not None]):
+        handlers[strategy['name']] = (strategy['handler'], strategy['params'])
+    if names is not None:
+        handlers = {name: handlers[name] for name in names}
+    return handlers
+
+
+def open_loop_inputs(data: pd.DataFrame, yts: int = 5) -> dict:
+    """
+    Convert recorded data to the one-minute handler inputs of a replay: glucose is linearly interpolated (also over
+    the CGM gaps), CHO is placed at the minute it was recorded, boluses (U/min) are spread over the yts minutes of
+    their sample and basal insulin is held between samples, as ReplayBG does.
+    Args:
+        data: pd.DataFrame, recorded data sorted by time (t, glucose, cho, cho_label, bolus and basal columns)
+        yts: int, sample time of the data (min), as given to ReplayBG
+    Returns:
+        inputs: dict, with the handler inputs 'glucose', 'meal_announcement', 'meal_type', 'hypotreatments',
+            'bolus' (U in each minute), 'basal' and 'time' (one-minute grid from the first sample to yts - 1
+            minutes after the last one)
+    """
+    t0 = data['t'].iloc[0]
+    minutes = ((data['t'] - t0) // pd.Timedelta("1min")).to_numpy()
+    n = int(minutes[-1]) + yts
+    grid = np.arange(n)
+
+    glucose = data['glucose'].to_numpy()
+    valid = ~np.isnan(glucose)
+
+    meal_announcement = np.zeros(n)
+    np.add.at(meal_announcement, minutes, data['cho'].fillna(0).to_numpy())
+    meal_type = np.full(n, '', dtype=object)
+    meals = data['cho'].to_numpy() > 0
+    meal_type[minutes[meals]] = data['cho_label'].fillna('').to_numpy()[meals]
+
+    bolus = np.zeros(n)
+    np.add.at(bolus, (minutes[:, None] + np.arange(yts)).ravel(), np.repeat(data['bolus'].fillna(0).to_numpy(), yts))
+
+    return {'glucose': np.interp(grid, minutes[valid], glucose[valid]),
+            'meal_announcement': meal_announcement,
+            'meal_type': meal_type,
+            'hypotreatments': np.zeros(n),
+            'bolus': bolus,
+            'basal': data['basal'].ffill().fillna(0).to_numpy()[np.searchsorted(minutes, grid, side='right') - 1],
+            'time': t0 + pd.to_timedelta(grid, unit='min')}
+
+
+def run_open_loop(handler: object, inputs: dict, params: dict, bolus_params: dict, step: int = 1) -> np.ndarray:
+    """
+    Call a handler over the inputs, as ReplayBG does during a replay, but keeping the recorded glucose. The suggested
+    correction boluses are added to the bolus history (as if they were taken) at the next minute, where ReplayBG
+    administers them, so that the handler sees them as in a replay.
+    Args:
+        handler: function, correction boluses handler
+        inputs: dict, one-minute handler inputs (see open_loop_inputs)
+        params: dict, correction_boluses_handler_params
+        bolus_params: dict, bolus_calculator_handler_params (cf and gt)
+        step: int, minutes between two calls of the handler (e.g., 5 to call it only at the CGM samples)
+    Returns:
+        cb: np.ndarray, correction bolus (U) suggested at each minute
+    """
+    dss = StubDSS(dict(bolus_params), dict(params))
+    glucose, meal_announcement, meal_type = inputs['glucose'], inputs['meal_announcement'], inputs['meal_type']
+    hypotreatments, basal, time = inputs['hypotreatments'], inputs['basal'], inputs['time']
+    bolus = inputs['bolus'].copy()
+
+    cb = np.zeros(bolus.size)
+    for time_index in range(0, bolus.size, step):
+        cb_t, dss = handler(glucose, meal_announcement, meal_type, hypotreatments, bolus, basal, time, time_index, dss)
+        if cb_t > 0:
+            cb[time_index] = cb_t
+            if time_index + 1 < bolus.size:
+                bolus[time_index + 1] += cb_t
+    return cb
+
+
+def advise(data: pd.DataFrame, subject_info: dict, t_pers: float = 120, names: list[str] | None = None,
+           step: int = 5, remove_corrections: bool = True) -> pd.DataFrame:
+    """
+    Correction boluses suggested by each strategy over recorded data (open loop: no twin and no simulation).
+    Args:
+        data: pd.DataFrame, recorded data (e.g., from load_trace)
+        subject_info: dict, subject information (cf and gt are used by the bolus calculator of the handlers)
+        t_pers: float, personalized parameter for drCORRECT
+        names: list, handlers to run (default: all, see advisor_handlers)
+        step: int, minutes between two calls of the handlers (5 to call them at the CGM samples, 1 as in a replay)
+        remove_corrections: bool, whether to remove the recorded correction boluses first (see remove_correction_boluses)
+    Returns:
+        suggestions: pd.DataFrame, one row per suggested correction bolus with columns 'strategy', 't',
+            'glucose' (mg/dl, at the time of the suggestion) and 'cb' (U)
+    """
+    if remove_corrections:
+        data = remove_correction_boluses(data)
+    inputs = open_loop_inputs(data)
+    bolus_params = {'cf': subject_info['cf'], 'gt': subject_info['gt']}
+
+    suggestions = []
+    for name, (handler, params) in advisor_handlers(subject_info, t_pers, names).items():
+        cb = run_open_loop(handler, inputs, params, bolus_params, step)
+        idx = np.flatnonzero(cb)
+        suggestions.append(pd.DataFrame({'strategy': name, 't': inputs['time'][idx], 'glucose': inputs['glucose'][idx], 'cb': cb[idx]}))
+
+    return pd.concat(suggestions, ignore_index=True)
+
+
+def _init_worker(data_folder: str, cache_folder: str | None, advise_kwargs: dict) -> None:
+    """
+    Store the settings used by a worker for all the traces it screens.
+    """
+    global _worker_config
+    _worker_config = {'data_folder': data_folder, 'cache_folder': cache_folder, 'advise_kwargs': advise_kwargs}
+
+
+def _advise_trace(trace_name: str) -> pd.DataFrame:
+    """
+    Run the advisor on a single trace inside a worker.
+    """
+    data, subject_info = load_trace(trace_name, _worker_config['data_folder'], _worker_config['cache_folder'])
+    return advise(data, subject_info, **_worker_config['advise_kwargs'])
+
+
+def advise_archive(data_folder: str, trace_names: list[str] | None = None, max_workers: int | None = None,
+                   cache_folder: str | None = None, output_path: str | None = None, **advise_kwargs) -> pd.DataFrame:
+    """
+    Run the advisor over many traces in parallel, as a screening pass. A failing trace is reported and skipped.
+    Args:
+        data_folder: str, folder containing Tidepool_<name>.csv files
+        trace_names: list, traces to screen (default: all the traces found in data_folder)
+        max_workers: int, number of worker processes (default: number of CPUs)
+        cache_folder: str, folder of the Parquet copies of the parsed traces (see load_trace)
+        output_path: str, Parquet file the suggestions are saved to (None to not save them)
+        advise_kwargs: options passed to advise (t_pers, names, step, remove_corrections)
+    Returns:
+        suggestions: pd.DataFrame, suggestions of all the traces (see advise) with a 'trace' column
+    """
+    if trace_names is None:
+        trace_names = discover_traces(data_folder)
+
+    suggestions = []
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                             initargs=(data_folder, cache_folder, advise_kwargs)) as executor:
+        futures = {executor.submit(_advise_trace, trace_name): trace_name for trace_name in trace_names}
+        for future in as_completed(futures):
+            trace_name = futures[future]
+            try:
+                df_trace = future.result()
+            except Exception:
+                print(f"Open-loop advice for {trace_name} failed:\n{traceback.format_exc()}")
+                continue
+            df_trace.insert(0, 'trace', trace_name)
+            suggestions.append(df_trace)
+
+    df = pd.concat(suggestions, ignore_index=True) if suggestions else pd.DataFrame(columns=['trace', 'strategy', 't', 'glucose', 'cb'])
+    df = df.sort_values(['trace', 'strategy', 't'], ignore_index=True)
+
+    if output_path is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        df.to_parquet(output_path, index=False)
+
+    return df
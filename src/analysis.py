@@ -2,84 +2,318 @@
 Analysis utilities to compare corrective insulin bolus strategies using replay simulations.
 """
 
-from src.handlers import drCORRECT, standard_cib, aleppo
+from src.strategies import build_strategies
+from src.utils import compute_metrics, realization_metrics
+from src.workspace import save_replay, workspace_path, REPLAY_ARRAYS
+from src.cache import ReplayCache
+from src.profiling import stage, instrument_handler, TimedHandler
 
+import os
+import pickle
+import tempfile
+from types import SimpleNamespace
 import pandas as pd
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
-from py_agata.variability import median_glucose
-from py_agata.time_in_ranges import time_in_hyperglycemia
 
+# Numbers of posterior draws a MCMC twin can be replayed with (the samples_<n> draws of the twin)
+REPLAY_SIZES = [1, 10, 100, 1000]
 
-def compare_corrective_strategies(rbg: object, data: pd.DataFrame, subject_info: dict, t_pers: float, twinning_method: str, save_name: str, trace_name: str) -> dict:
+
+def default_strategies(subject_info: dict, t_pers: float, twinning_method: str) -> list[dict]:
+    """
+    Build the list of strategies to compare from the strategy registry (see src.strategies).
+    Args:
+        subject_info: dict, subject information
+        t_pers: float, personalized parameter for drCORRECT
+        twinning_method: str, method used for twinning ('map' or 'mcmc')
+    Returns:
+        strategies: list, one dict per registered strategy (see build_strategies)
+    """
+    return build_strategies(subject_info, t_pers, twinning_method)
+
+
+def day_index(data: pd.DataFrame, day_length: str = "1D") -> np.ndarray:
+    """
+    Day segment of each sample of a trace, counting windows of day_length from the first sample (so that a
+    single-day trace crossing midnight stays one segment).
+    Args:
+        data: pd.DataFrame, data sorted by time
+        day_length: str, length of a segment (pandas Timedelta string)
+    Returns:
+        day: np.ndarray, segment number of each row (0 for the first day_length of data)
+    """
+    return ((data['t'] - data['t'].iloc[0]) // pd.Timedelta(day_length)).to_numpy()
+
+
+def remove_correction_boluses(data: pd.DataFrame, day_length: str = "1D") -> pd.DataFrame:
+    """
+    Remove the correction boluses given in the meal windows of the original data, i.e. after the first meal bolus
+    (B, L or D) of each day segment (see day_index). Corrections of days without meal boluses are kept.
+    Args:
+        data: pd.DataFrame, original data sorted by time
+        day_length: str, length of a day segment
+    Returns:
+        data_no_cib: pd.DataFrame, copy of data without the correction boluses
+    """
+    data_no_cib = data.copy()
+    after_meal = data_no_cib['bolus_label'].isin(['B', 'L', 'D']).groupby(day_index(data_no_cib, day_length)).cummax()
+    corrections = (data_no_cib['bolus_label'] == 'C') & after_meal
+    data_no_cib.loc[corrections, 'bolus'] = 0
+    data_no_cib.loc[corrections, 'bolus_label'] = ''
+    
+    return data_no_cib
+
+
+def day_segments(data: pd.DataFrame, day_length: str = "1D") -> list[pd.DataFrame]:
+    """
+    Split a multi-day trace into day segments (see day_index) that can be replayed independently: each segment
+    replay starts from the initial state of the twin and from fresh handler state (see replay_strategy). Note that
+    the glucose and insulin on board at the end of a segment are therefore not carried over to the next one.
+    Args:
+        data: pd.DataFrame, data sorted by time
+        day_length: str, length of a segment
+    Returns:
+        segments: list, data of each non-empty segment, in chronological order
+    """
+    return [segment.reset_index(drop=True) for _, segment in data.groupby(day_index(data, day_length), sort=True)]
+
+
+def stitch_days(replays: list[dict]) -> dict:
+    """
+    Stitch the results of replays of consecutive day segments (see day_segments) on the one-minute grid of the whole
+    trace. Minutes not simulated by any segment (gaps between segments) have nan glucose, ignored by the metrics,
+    and no CHO or insulin, so the stitched grid can be longer than the data of the segments.
+    Args:
+        replays: list, ReplayBG replay results of the segments, in chronological order
+    Returns:
+        replay_results: dict, results of the whole trace
+    """
+    if len(replays) == 1:
+        return replays[0]
+
+    t_data = [np.asarray(replay['rbg_data'].t_data).astype('datetime64[m]') for replay in replays]
+    offsets = [int((t[0] - t_data[0][0]) // np.timedelta64(1, 'm')) for t in t_data]
+    n = offsets[-1] + np.asarray(replays[-1]['glucose']['median']).size
+
+    stitched = {'rbg_data': SimpleNamespace(t_data=np.concatenate([np.asarray(replay['rbg_data'].t_data) for replay in replays]))}
+    for key in ['glucose'] + REPLAY_ARRAYS:
+        n_realizations = np.atleast_2d(replays[0][key]['realizations']).shape[0]
+        realizations = np.full((n_realizations, n), np.nan if key == 'glucose' else 0.)
+        for offset, replay in zip(offsets, replays):
+            segment = np.atleast_2d(replay[key]['realizations'])
+            realizations[:, offset:offset + segment.shape[1]] = segment
+        stitched[key] = {'realizations': realizations}
+    stitched['glucose']['median'] = np.full(n, np.nan)
+    for offset, replay in zip(offsets, replays):
+        median = np.asarray(replay['glucose']['median'])
+        stitched['glucose']['median'][offset:offset + median.size] = median
+    return stitched
+
+
+def split_twin(rbg: object, save_name: str, twinning_method: str, n_replay: int, n_chunks: int) -> list[str]:
+    """
+    Split the first n_replay posterior draws of a MCMC twin into n_chunks twins, so that the realizations can be
+    replayed in parallel. Chunk k is saved as the twin <save_name>_r<k>_<n_chunks>, whose n_replay / n_chunks draws
+    are draws k * n_replay / n_chunks to (k + 1) * n_replay / n_chunks - 1 of the original twin.
+    Args:
+        rbg: ReplayBG object, instantiated digital twin tool
+        save_name: str, name of the twin
+        twinning_method: str, method used for twinning ('map' or 'mcmc')
+        n_replay: int, number of realizations (1, 10, 100 or 1000)
+        n_chunks: int, number of chunks (n_replay / n_chunks must be 1, 10, 100 or 1000)
+    Returns:
+        save_names: list, names of the chunk twins, in the order of the draws ([save_name] for a single chunk);
+            remove them with remove_split_twin once replayed
+    """
+    if n_replay not in REPLAY_SIZES or (twinning_method != 'mcmc' and n_replay != 1):
+        raise ValueError(f"Cannot replay {n_replay} realizations of a {twinning_method} twin, use one of {REPLAY_SIZES} (1 for map twins).")
+    if n_chunks == 1:
+        return [save_name]
+    chunk_size = n_replay // n_chunks
+    if twinning_method != 'mcmc' or n_replay % n_chunks or chunk_size not in REPLAY_SIZES:
+        raise ValueError(f"Cannot split {n_replay} realizations of a {twinning_method} twin into {n_chunks} chunks of {REPLAY_SIZES} draws.")
+
+    twin_folder = os.path.join(rbg.environment.replay_bg_path, "results", twinning_method)
+    with open(os.path.join(twin_folder, f"{twinning_method}_{save_name}.pkl"), 'rb') as f:
+        twin = pickle.load(f)
+
+    save_names = []
+    for k in range(n_chunks):
+        chunk_name = f"{save_name}_r{k}_{n_chunks}"
+        draws = {p: dict(samples, **{f'samples_{chunk_size}': np.asarray(samples[f'samples_{n_replay}'])[k * chunk_size:(k + 1) * chunk_size]})
+                 for p, samples in twin['draws'].items()}
+        fd, tmp_path = tempfile.mkstemp(prefix=f".{chunk_name}.", suffix=".pkl", dir=twin_folder)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(dict(twin, draws=draws), f)
+        os.replace(tmp_path, os.path.join(twin_folder, f"{twinning_method}_{chunk_name}.pkl"))
+        save_names.append(chunk_name)
+    return save_names
+
+
+def remove_split_twin(rbg: object, save_names: list[str], twinning_method: str) -> None:
+    """
+    Remove the chunk twins written by split_twin (a single name is the original twin, which is kept).
+    """
+    if len(save_names) == 1:
+        return
+    for save_name in save_names:
+        try:
+            os.remove(os.path.join(rbg.environment.replay_bg_path, "results", twinning_method, f"{twinning_method}_{save_name}.pkl"))
+        except FileNotFoundError:
+            pass
+
+
+def merge_realizations(replays: list[dict]) -> dict:
+    """
+    Stitch the results of replays of the same data with different posterior draws (e.g., the chunks of split_twin),
+    recomputing the median glucose and its percentiles over all the realizations.
+    Args:
+        replays: list, ReplayBG replay results, in the order of the draws
+    Returns:
+        replay_results: dict, results with the realizations of all the replays
+    """
+    if len(replays) == 1:
+        return replays[0]
+
+    merged = {'rbg_data': replays[0]['rbg_data']}
+    for key in ['glucose'] + REPLAY_ARRAYS:
+        merged[key] = {'realizations': np.concatenate([np.atleast_2d(replay[key]['realizations']) for replay in replays])}
+        merged[key]['median'] = np.median(merged[key]['realizations'], axis=0)
+    percentiles = np.percentile(merged['glucose']['realizations'], [5, 25, 75, 95], axis=0)
+    merged['glucose'].update(zip(['ci5th', 'ci25th', 'ci75th', 'ci95th'], percentiles))
+    return merged
+
+
+def replay_strategy(rbg: object, data: pd.DataFrame, subject_info: dict, twinning_method: str, save_name: str, strategy: dict,
+                    cache: ReplayCache | None = None, n_replay: int = 1) -> dict:
+    """
+    Replay data with a single corrective insulin bolus strategy.
+    Args:
+        rbg: ReplayBG object, instantiated digital twin tool
+        data: pd.DataFrame, data to replay (without correction boluses)
+        subject_info: dict, subject information
+        twinning_method: str, method used for twinning ('map' or 'mcmc')
+        save_name: str, name of the twin
+        strategy: dict, strategy as returned by default_strategies
+        cache: ReplayCache, cache of replay results to reuse (None to always replay)
+        n_replay: int, number of realizations, i.e. of posterior draws of a MCMC twin (1, 10, 100 or 1000)
+    Returns:
+        replay_results: dict, ReplayBG replay results (also saved as a compact workspace, see src.workspace, 
+            if the strategy has a save_suffix)
+    """
+    replay_kwargs = dict(data=data, bw=subject_info['bw'], save_name=save_name,
+                         n_replay=n_replay,
+                         twinning_method=twinning_method,
+                         save_workspace=False)
+    if strategy['handler'] is None:
+        with stage('replay', save_name=save_name, strategy=strategy['name']):
+            return rbg.replay(**replay_kwargs) if cache is None else cache.replay(rbg, **replay_kwargs)
+    
+    handler = instrument_handler(strategy['handler'])
+    # the handlers keep their state (e.g., event_index, previous_mealtime) in the params held by the DSS: each replay
+    # gets its own copy, so that concurrent replays do not share it and the cache key only depends on the strategy
+    replay_kwargs.update(enable_correction_boluses=True,
+                         correction_boluses_handler=handler,
+                         correction_boluses_handler_params=dict(strategy['params']))
+    with stage('replay', save_name=save_name, strategy=strategy['name']) as record:
+        replay_results = rbg.replay(**replay_kwargs) if cache is None else cache.replay(rbg, **replay_kwargs)
+        if isinstance(handler, TimedHandler):
+            record['handler_calls'] = handler.calls
+            record['handler_seconds'] = handler.seconds
+            record['profile'] = handler.dump_stats(f"{save_name}_{strategy['name']}")
+    if strategy['save_suffix'] is not None:
+        save_replay(replay_results, workspace_path(rbg, save_name, strategy['save_suffix']))
+    
+    return replay_results
+
+
+def compare_corrective_strategies(rbg: object, data: pd.DataFrame, subject_info: dict, t_pers: float | dict, twinning_method: str, save_name: str, trace_name: str,
+                                  strategies: list[dict] | None = None, executor: str | None = None, max_workers: int | None = None,
+                                  cache: ReplayCache | None = None, n_replay: int = 1, n_chunks: int = 1, split_days: bool = False) -> dict:
     """
     Compare different corrective insulin bolus strategies using ReplayBG simulations.
     Args:
         rbg: ReplayBG object, instantiated digital twin tool
         data: pd.DataFrame, original data
         subject_info: dict, subject information
-        t_pers: float, personalized parameter for drCORRECT
+        t_pers: float, personalized parameter for drCORRECT, or its posterior distribution as returned by 
+            retrieve_t_pers_distribution (the median is used)
         twinning_method: str, method used for twinning ('map' or 'mcmc')
         save_name: str, name of the twin
         trace_name: str, name of the trace
+        strategies: list, strategies to compare, either built strategies or names of registered ones (default: all the registered strategies)
+        executor: str, None to replay the strategies one after another, 'process' to replay them in parallel (the
+            supported parallel mode: each worker process gets its own copy of rbg), or 'thread' to share rbg between
+            threads, which is only meant for replays expected to be cache hits (I/O bound): rbg.replay is not known to
+            be thread safe, and the handlers are pure Python, so the GIL serializes the simulations anyway
+        max_workers: int, number of parallel workers (default: one per replay, up to the number of CPUs)
+        cache: ReplayCache, cache of replay results to reuse (None to always replay)
+        n_replay: int, number of realizations replayed for each strategy (1, 10, 100 or 1000 posterior draws of a MCMC twin)
+        n_chunks: int, number of chunks the realizations are split into (see split_twin), replayed in parallel by the executor
+        split_days: bool, whether to replay each day of a multi-day trace separately (see day_segments), in parallel by
+            the executor, and stitch the days together (see stitch_days); no handler state is carried from a day to the
+            next, so the results do not depend on the executor. Limitations: every day starts from the initial state
+            of the twin (no glucose or insulin carry-over between days), and the minutes between days have nan glucose
     Returns:
         results: dict, containing replay results for each corrective strategy"""
     
-    data_no_cib = data.copy()
-    B_idx = np.where(data_no_cib['bolus_label'] == 'B')[0][0]
-    C_idx = np.where(data_no_cib['bolus_label'] == 'C')[0]
-    data_no_cib['bolus'][C_idx[C_idx > B_idx]] = 0  # remove correction boluses after breakfast from original data
-    data_no_cib['bolus_label'][C_idx[C_idx > B_idx]] = ''
+    data_no_cib = remove_correction_boluses(data)
+    
+    if isinstance(t_pers, dict):
+        t_pers = t_pers['median']
+    
+    if strategies is None:
+        strategies = default_strategies(subject_info, t_pers, twinning_method)
+    elif all(isinstance(strategy, str) for strategy in strategies):
+        strategies = build_strategies(subject_info, t_pers, twinning_method, names=strategies)
     
-    print("Replaying Tidepool " + trace_name + " data with original CIB.")
-    original_replay = rbg.replay(data=data_no_cib, bw=subject_info['bw'], save_name=save_name,
-                                 n_replay=1,
-                                 twinning_method=twinning_method,
-                                 save_workspace=False
-    )
-    tt = pd.date_range(start=original_replay['rbg_data'].t_data.min(), end=original_replay['rbg_data'].t_data.max()+pd.Timedelta("4min"),freq="1min")
-    df_res = pd.DataFrame(pd.DataFrame({
-                            't': tt,
-                            'glucose': original_replay['glucose']['median']
-                        }))
-    print('Mean glucose: %.2f mg/dl' % median_glucose(df_res))
-    print('TAR: %.2f %% \n' % time_in_hyperglycemia(df_res))
+    # one replay per strategy, chunk of realizations and day segment
+    chunk_names = split_twin(rbg, save_name, twinning_method, n_replay, n_chunks)
+    segments = day_segments(data_no_cib) if split_days else [data_no_cib]
+    tasks = [(chunk_name, segment) for chunk_name in chunk_names for segment in segments]
+    task_strategies = strategies if len(tasks) == 1 else [dict(strategy, save_suffix=None) for strategy in strategies]
     
-    print("Replaying Tidepool " + trace_name + " data using Aleppo's guidelines.")
-    aleppo_replay = rbg.replay(data=data_no_cib, bw=subject_info['bw'], save_name=save_name,
-                                enable_correction_boluses=True,
-                                correction_boluses_handler=aleppo,
-                                correction_boluses_handler_params={'gt': subject_info['gt'], 'cf': subject_info['cf']},
-                                save_suffix=f'_aleppo_replay_{twinning_method}',
-                                n_replay=1,
-                                twinning_method=twinning_method,
-                                save_workspace=True
-    )
-    df_res = pd.DataFrame(pd.DataFrame({
-                            't': tt,
-                            'glucose': aleppo_replay['glucose']['median']
-                        }))
-    print('Mean glucose: %.2f mg/dl' % median_glucose(df_res))
-    print('TAR: %.2f %% \n' % time_in_hyperglycemia(df_res))
+    try:
+        if executor is None:
+            replays = {}
+            for strategy in task_strategies:
+                print("Replaying Tidepool " + trace_name + " data " + strategy.get('label', 'using ' + strategy['name'] + '.'))
+                replays[strategy['name']] = [replay_strategy(rbg, segment, subject_info, twinning_method, chunk_name, strategy, cache, n_replay // n_chunks)
+                                             for chunk_name, segment in tasks]
+        else:
+            n_workers = max_workers or min(len(strategies) * len(tasks), os.cpu_count() or 1)
+            if executor == 'thread':
+                pool = ThreadPoolExecutor(max_workers=n_workers)
+            elif executor == 'process':
+                pool = ProcessPoolExecutor(max_workers=n_workers)
+            else:
+                raise ValueError(f"Unknown executor '{executor}', use None, 'thread' or 'process'.")
+            print("Replaying Tidepool " + trace_name + " data with " + str(len(strategies)) + " strategies in parallel.")
+            with pool:
+                futures = {strategy['name']: [pool.submit(replay_strategy, rbg, segment, subject_info, twinning_method, chunk_name, strategy, cache, n_replay // n_chunks)
+                                              for chunk_name, segment in tasks]
+                           for strategy in task_strategies}
+                replays = {name: [future.result() for future in task_futures] for name, task_futures in futures.items()}
+    finally:
+        remove_split_twin(rbg, chunk_names, twinning_method)
     
-    print("Replaying Tidepool " + trace_name + " data using drCORRECT algorithm...")
-    drcorrect_replay = rbg.replay(data=data_no_cib, bw=subject_info['bw'], save_name=save_name,
-                                enable_correction_boluses=True,
-                                correction_boluses_handler=drCORRECT,
-                                correction_boluses_handler_params={'gt': subject_info['gt'], 'cf': subject_info['cf'], 't_pers': t_pers},
-                                save_suffix=f'_drcorrect_replay_{twinning_method}',
-                                n_replay=1,
-                                twinning_method=twinning_method,
-                                save_workspace=True
-    )
-    df_res = pd.DataFrame(pd.DataFrame({
-                            't': tt,
-                            'glucose': drcorrect_replay['glucose']['median']
-                        }))
-    print('Mean glucose: %.2f mg/dl' % median_glucose(df_res))
-    print('TAR: %.2f %% \n' % time_in_hyperglycemia(df_res))
+    results = {}
+    for strategy in strategies:
+        name = strategy['name']
+        replay = merge_realizations([stitch_days(replays[name][k * len(segments):(k + 1) * len(segments)]) for k in range(len(chunk_names))])
+        if len(tasks) > 1 and strategy['save_suffix'] is not None:
+            save_replay(replay, workspace_path(rbg, save_name, strategy['save_suffix']))
+        if n_replay == 1:
+            metrics = compute_metrics(replay, (trace_name, name))
+            print(name + ' - Mean glucose: %.2f mg/dl' % metrics['Median Glucose (mg/dl)'])
+            print(name + ' - TAR: %.2f %% \n' % metrics['TAR (%)'])
+        else:
+            metrics = realization_metrics(replay, (trace_name, name))
+            print(name + ' - Mean glucose: %.2f mg/dl (95%% band %.2f-%.2f)' % (metrics['median']['Median Glucose (mg/dl)'],
+                                                                              metrics['ci_low']['Median Glucose (mg/dl)'], metrics['ci_high']['Median Glucose (mg/dl)']))
+            print(name + ' - TAR: %.2f %% (95%% band %.2f-%.2f) \n' % (metrics['median']['TAR (%)'], metrics['ci_low']['TAR (%)'], metrics['ci_high']['TAR (%)']))
+        results[name] = replay
     
-    return {
-        'Original data': original_replay,
-        'Aleppo guidelines': aleppo_replay,
-        'drCORRECT algorithm': drcorrect_replay}
\ No newline at end of file
+    return results
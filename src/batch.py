@@ -0,0 +1,158 @@
+"""
+Batch comparison of corrective strategies over many Tidepool traces using a process pool.
+"""
+
+import os
+import glob
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import matplotlib
+import pandas as pd
+
+from py_replay_bg.py_replay_bg import ReplayBG
+
+from src.utils import load_trace, retrieve_t_pers, save_comparison, clear_metrics_cache
+from src.analysis import compare_corrective_strategies
+from src.store import compact_results
+from src.visualization import original_data_template, comparison_template, plot_original_data, plot_comparison
+
+
+# ReplayBG instance and figure templates owned by each worker process (created once by _init_worker and reused)
+_worker_rbg = None
+_worker_config = {}
+_worker_templates = {}
+
+
+def discover_traces(data_folder: str) -> list[str]:
+    """
+    Find the Tidepool traces available in a folder.
+    Args:
+        data_folder: str, folder containing Tidepool_<name>.csv files
+    Returns:
+        trace_names: list, sorted names of the traces
+    """
+    files = glob.glob(os.path.join(data_folder, "Tidepool_*.csv"))
+    return sorted(os.path.basename(f)[len("Tidepool_"):-len(".csv")] for f in files)
+
+
+def _init_worker(data_folder: str, save_folder: str, twinning_method: str, verbose: bool, cache_folder: str | None,
+                 plot_folder: str | None, plot_traces: set[str] | None, n_replay: int, split_days: bool) -> None:
+    """
+    Instantiate the ReplayBG object used by a worker for all the traces it processes.
+    """
+    global _worker_rbg, _worker_config
+    matplotlib.use('Agg')
+    _worker_rbg = ReplayBG(
+        blueprint="multi-meal", save_folder=save_folder,
+        yts=5,
+        seed=1,
+        verbose=verbose, plot_mode=False
+    )
+    _worker_config = {'data_folder': data_folder, 'save_folder': save_folder, 'twinning_method': twinning_method,
+                      'cache_folder': cache_folder, 'plot_folder': plot_folder, 'plot_traces': plot_traces, 'n_replay': n_replay,
+                      'split_days': split_days}
+
+
+def _compare_trace(trace_name: str) -> pd.DataFrame:
+    """
+    Run the strategy comparison of a single trace inside a worker.
+    Args:
+        trace_name: str, name of the trace
+    Returns:
+        df: pd.DataFrame, comparison results of the trace (metrics x strategies)
+    """
+    data_folder = _worker_config['data_folder']
+    save_folder = _worker_config['save_folder']
+    twinning_method = _worker_config['twinning_method']
+
+    original_data, subject_info = load_trace(trace_name, data_folder, _worker_config['cache_folder'])
+    save_name = "cib_comparison_tidepool_" + trace_name
+
+    t_pers = retrieve_t_pers(save_name, subject_info, save_folder, twinning_method)
+    results = compare_corrective_strategies(_worker_rbg, original_data, subject_info, t_pers, twinning_method, save_name, trace_name,
+                                            n_replay=_worker_config['n_replay'], split_days=_worker_config['split_days'])
+
+    plot_traces = _worker_config['plot_traces']
+    if _worker_config['plot_folder'] is not None and (plot_traces is None or trace_name in plot_traces):
+        _plot_trace(trace_name, original_data, results)
+
+    try:
+        return save_comparison(results, os.path.join(save_folder, "results", "comparison_results"), trace_name, twinning_method,
+                               store_folder=os.path.join(save_folder, "results", "cohort"))
+    finally:
+        clear_metrics_cache()  # the metrics of a trace are not needed by the next ones
+
+
+def _plot_trace(trace_name: str, original_data: pd.DataFrame, results: dict) -> None:
+    """
+    Render the original data and comparison plots of a trace inside a worker, reusing its headless figure templates.
+    """
+    names = tuple(results)
+    if 'original' not in _worker_templates:
+        _worker_templates['original'] = original_data_template()
+    if names not in _worker_templates:
+        _worker_templates[names] = comparison_template(list(names))
+
+    plot_original_data(original_data, _worker_config['plot_folder'], trace_name, _worker_templates['original'])
+    plot_comparison(results, _worker_config['plot_folder'], trace_name, _worker_config['twinning_method'], _worker_templates[names])
+
+
+def run_batch(data_folder: str, save_folder: str, twinning_method: str = 'mcmc', trace_names: list[str] | None = None,
+              max_workers: int | None = None, verbose: bool = False, cache_folder: str | None = None,
+              plot_folder: str | None = None, plot_traces: list[str] | None = None, n_replay: int = 1,
+              split_days: bool = False) -> pd.DataFrame:
+    """
+    Compare the corrective strategies on many traces in parallel. A failing trace is reported and skipped.
+    Plots are optionally rendered by the same workers (headless, with figure templates reused across traces).
+    Args:
+        data_folder: str, folder containing Tidepool_<name>.csv files
+        save_folder: str, ReplayBG save folder (containing results/<twinning_method>/ twins)
+        twinning_method: str, method used for twinning ('map' or 'mcmc')
+        trace_names: list, traces to process (default: all the traces found in data_folder)
+        max_workers: int, number of worker processes (default: number of CPUs)
+        verbose: bool, ReplayBG verbosity in the workers
+        cache_folder: str, folder of the Parquet copies of the parsed traces (see load_trace)
+        plot_folder: str, folder of the original data and comparison plots (None to not plot)
+        plot_traces: list, traces to plot if plot_folder is set (default: all the processed traces)
+        n_replay: int, number of realizations replayed for each strategy (see compare_corrective_strategies)
+        split_days: bool, whether to replay the days of multi-day traces separately (see compare_corrective_strategies)
+    Returns:
+        df: pd.DataFrame, combined results with one row per trace and strategy, plus a 'status' column
+            (the results of the successful traces are also appended to the cohort store in results/cohort and compacted, see src.store)
+    """
+    if trace_names is None:
+        trace_names = discover_traces(data_folder)
+    if plot_folder is not None:
+        os.makedirs(plot_folder, exist_ok=True)
+
+    rows = []
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                             initargs=(data_folder, save_folder, twinning_method, verbose, cache_folder,
+                                       plot_folder, None if plot_traces is None else set(plot_traces), n_replay, split_days)) as executor:
+        futures = {executor.submit(_compare_trace, trace_name): trace_name for trace_name in trace_names}
+        for future in as_completed(futures):
+            trace_name = futures[future]
+            try:
+                df_trace = future.result()
+            except Exception:
+                print(f"Comparison for {trace_name} failed:\n{traceback.format_exc()}")
+                rows.append(pd.DataFrame({'trace': [trace_name], 'strategy': [None], 'status': ['failed']}))
+                continue
+            df_trace = df_trace.T.rename_axis('strategy').reset_index()
+            df_trace.insert(0, 'trace', trace_name)
+            df_trace['status'] = 'ok'
+            rows.append(df_trace)
+
+    df = pd.concat(rows, ignore_index=True) if rows else pd.DataFrame(columns=['trace', 'strategy', 'status'])
+    df = df[[c for c in df.columns if c != 'status'] + ['status']]
+    df = df.sort_values(['trace', 'strategy'], na_position='last', ignore_index=True)
+
+    # merge the per-trace files written by the workers into the single file of the cohort store partition
+    compact_results(os.path.join(save_folder, "results", "cohort"), twinning_method)
+
+    results_folder = os.path.join(save_folder, "results", "comparison_results")
+    os.makedirs(results_folder, exist_ok=True)
+    df.to_csv(os.path.join(results_folder, f"batch_comparison_results_{twinning_method}.csv"), index=False)
+
+    return df
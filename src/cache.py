@@ -0,0 +1,173 @@
+"""
+On-disk, content-addressed cache of replay results with size-bounded LRU eviction.
+"""
+
+import os
+import sys
+import glob
+import types
+import hashlib
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from src.workspace import save_replay, load_replay
+
+
+class ReplayCache:
+    """
+    Cache of replay results keyed by a hash of the twin, the replayed data, the correction boluses handler
+    (identity, code, constants and source of its module, so that editing a helper or a threshold of
+    src/handlers.py invalidates its replays), its params and the other replay settings. Results are stored as float64 compact
+    workspaces (see src.workspace); when the cache grows above max_bytes, the least recently used entries are removed.
+    """
+
+    def __init__(self, cache_folder: str, max_bytes: int = 1024**3):
+        self.cache_folder = cache_folder
+        self.max_bytes = max_bytes
+        self._twin_hashes = {}
+        self._source_hashes = {}
+        os.makedirs(cache_folder, exist_ok=True)
+
+    def key(self, rbg: object, **replay_kwargs) -> str:
+        """
+        Compute the cache key of a replay.
+        Args:
+            rbg: ReplayBG object, instantiated digital twin tool
+            replay_kwargs: arguments of rbg.replay
+        Returns:
+            key: str, hex digest identifying the replay
+        """
+        h = hashlib.sha256()
+
+        # twin
+        twinning_method = replay_kwargs.get('twinning_method', 'mcmc')
+        h.update(self._twin_hash(os.path.join(rbg.environment.replay_bg_path, "results", twinning_method,
+                                              f"{twinning_method}_{replay_kwargs['save_name']}.pkl")).encode())
+        env = rbg.environment
+        h.update(repr((env.blueprint, env.yts, env.seed, env.exercise)).encode())
+
+        # data
+        data = replay_kwargs['data']
+        h.update(repr(list(zip(data.columns, data.dtypes.astype(str)))).encode())
+        h.update(pd.util.hash_pandas_object(data, index=True).values.tobytes())
+
+        # handler and other settings (save_workspace does not change the results)
+        for name, value in sorted(replay_kwargs.items()):
+            if name in ('data', 'save_workspace'):
+                continue
+            if callable(value):
+                value = getattr(value, '__wrapped__', value)  # e.g., TimedHandler
+                code = getattr(value, '__code__', None)
+                value = (value.__module__, getattr(value, '__qualname__', type(value).__qualname__),
+                         _code_hash(code) if code is not None else None, self._source_hash(value.__module__))
+            elif isinstance(value, dict):
+                value = sorted(value.items())
+            h.update(repr((name, value)).encode())
+
+        return h.hexdigest()
+
+    def get(self, key: str) -> object | None:
+        """
+        Get the replay results stored under key (None if missing), marking them as recently used.
+        """
+        path = self._path(key)
+        try:
+            os.utime(path)
+            with load_replay(path) as workspace:
+                return workspace.load()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, replay_results: dict) -> None:
+        """
+        Store replay results under key and evict the least recently used entries if needed.
+        """
+        fd, tmp_path = tempfile.mkstemp(prefix=f".{key}.", suffix=".npz", dir=self.cache_folder)
+        os.close(fd)
+        try:
+            save_replay(replay_results, tmp_path, dtype=np.float64)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def replay(self, rbg: object, **replay_kwargs) -> object:
+        """
+        Return the cached results of rbg.replay(**replay_kwargs), running and storing the replay on a miss.
+        """
+        key = self.key(rbg, **replay_kwargs)
+        replay_results = self.get(key)
+        if replay_results is None:
+            replay_results = rbg.replay(**replay_kwargs)
+            self.put(key, replay_results)
+        return replay_results
+
+    def evict(self) -> None:
+        """
+        Remove the least recently used entries until the cache fits in max_bytes.
+        """
+        entries = []
+        for path in glob.glob(os.path.join(self.cache_folder, "*.npz")):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self) -> None:
+        """
+        Remove all the entries.
+        """
+        for path in glob.glob(os.path.join(self.cache_folder, "*.npz")):
+            os.remove(path)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_folder, key + ".npz")
+
+    def _source_hash(self, module_name: str) -> str | None:
+        """
+        Hash of the source file of a module (None if it has none), recomputed only when the file changes.
+        """
+        path = getattr(sys.modules.get(module_name), '__file__', None)
+        if path is None:
+            return None
+        stat = os.stat(path)
+        signature = (path, stat.st_mtime_ns, stat.st_size)
+        if signature not in self._source_hashes:
+            with open(path, 'rb') as f:
+                self._source_hashes[signature] = hashlib.sha256(f.read()).hexdigest()
+        return self._source_hashes[signature]
+
+    def _twin_hash(self, twin_path: str) -> str:
+        """
+        Hash of the twin file, recomputed only when the file changes.
+        """
+        stat = os.stat(twin_path)
+        signature = (twin_path, stat.st_mtime_ns, stat.st_size)
+        if signature not in self._twin_hashes:
+            with open(twin_path, 'rb') as f:
+                self._twin_hashes[signature] = hashlib.sha256(f.read()).hexdigest()
+        return self._twin_hashes[signature]
+
+
+def _code_hash(code: types.CodeType) -> str:
+    """
+    Hash of the bytecode and of the constants of a code object (nested code objects, e.g. of lambdas, included).
+    """
+    h = hashlib.sha256(code.co_code)
+    for const in code.co_consts:
+        h.update((_code_hash(const) if isinstance(const, types.CodeType) else repr(const)).encode())
+    return h.hexdigest()
@@ -2,9 +2,9 @@
 Handlers for correction bolus strategies used during replay simulations.
 """
 
+from bisect import bisect_left, bisect_right
+
 import numpy as np
-import pandas as pd
-from py_agata.risk import dynamic_risk #, static_risk
 
 def standard_cib(
         glucose: np.ndarray,
@@ -184,19 +184,14 @@ def aleppo(
     check_after_1h = dss.bolus_calculator_handler_params['check_after_1h'] if 'check_after_1h' in dss.bolus_calculator_handler_params else False
     
     # get last mealtime
-    last_mealtime = get_last_mealtime(meal_announcement, meal_type, time_index)
+    events = update_event_index(meal_announcement, meal_type, bolus, time_index, dss)
+    last_mealtime = events.get_last_mealtime(time_index)
     
     # if there has been a meal, trigger the algorithm
     if last_mealtime > 0:
         
         # get last mealtime bolus (if no bolus, consider when meal was announced)
-        bolus_indices = np.where(bolus[:time_index] > 0)[0]
-
-        if last_mealtime == -1 or len(bolus_indices) == 0:
-            last_mealbolustime = last_mealtime
-        else:
-            nearby_boluses = bolus_indices[np.abs(bolus_indices - last_mealtime) <= 4]
-            last_mealbolustime = nearby_boluses[-1] if len(nearby_boluses) > 0 else last_mealtime
+        last_mealbolustime = events.get_meal_bolustime(last_mealtime, time_index)
             
         # get params
         cf = dss.bolus_calculator_handler_params.get('cf', 40)
@@ -226,61 +221,7 @@ def aleppo(
             
         elif time_index - last_mealbolustime > 4*60 and not np.any(bolus[(time_index - 2*60):time_index]):
             # get Aleppo's correction
-            correction_trend = 0
-            if arrow == -1:
-                if cf < 25:
-                    correction_trend = -2.5
-                elif cf < 50:
-                    correction_trend = -1.5
-                elif cf < 75:
-                    correction_trend = -1
-                else:
-                    correction_trend = -0.5
-            elif arrow == -2:
-                if cf < 25:
-                    correction_trend = -3.5
-                elif cf < 50:
-                    correction_trend = -2.5
-                elif cf < 75:
-                    correction_trend = -1.5
-                else:
-                    correction_trend = -1
-            elif arrow == -3:
-                if cf < 25:
-                    correction_trend = -4.5
-                elif cf < 50:
-                    correction_trend = -3.5
-                elif cf < 75:
-                    correction_trend = -2.5
-                else:
-                    correction_trend = -1.5
-            elif arrow == 1:
-                if cf < 25:
-                    correction_trend = +2.5
-                elif cf < 50:
-                    correction_trend = +1.5
-                elif cf < 75:
-                    correction_trend = +1
-                else:
-                    correction_trend = +0.5
-            elif arrow == 2:
-                if cf < 25:
-                    correction_trend = +3.5
-                elif cf < 50:
-                    correction_trend = +2.5
-                elif cf < 75:
-                    correction_trend = +1.5
-                else:
-                    correction_trend = +1
-            elif arrow == 3:
-                if cf < 25:
-                    correction_trend = +4.5
-                elif cf < 50:
-                    correction_trend = +3.5
-                elif cf < 75:
-                    correction_trend = +2.5
-                else:
-                    correction_trend = +1.5
+            correction_trend = trend_correction(arrow, cf)
                     
             # ...give a bolus
             cb = np.max([0, (glucose[time_index] - gt) / cf - iob + correction_trend])
@@ -368,43 +309,32 @@ def drCORRECT(
     cb = 0
     
     # get last mealtime and its label
-    last_mealtime = get_last_mealtime(meal_announcement, meal_type, time_index) 
+    events = update_event_index(meal_announcement, meal_type, bolus, time_index, dss)
+    last_mealtime = events.get_last_mealtime(time_index)
     if last_mealtime != dss.correction_boluses_handler_params.get('previous_mealtime', -1):
         # reset when a new main meal occurs
         dss.correction_boluses_handler_params['previous_mealtime'] = last_mealtime
         dss.correction_boluses_handler_params['first_bolus_after_meal'] = True
-        
-    t = pd.date_range(start=pd.Timestamp.today().normalize(),
-                               periods=10, freq='5min')
     
-    t_pers = dss.correction_boluses_handler_params.get('t_pers', 120)
+    # resolve parameter defaults once per replay
+    if not dss.correction_boluses_handler_params.get('prepared', False):
+        dss.correction_boluses_handler_params.update(prepare_drcorrect_params(dss.correction_boluses_handler_params))
+    
+    t_pers = dss.correction_boluses_handler_params['t_pers']
+    dr_threshold = dss.correction_boluses_handler_params['dr_threshold']
     first_bolus_after_meal = dss.correction_boluses_handler_params.get('first_bolus_after_meal', True)
 
-    dr_threshold = dss.correction_boluses_handler_params.get(
-        'dr_threshold',
-        dynamic_risk(
-            pd.DataFrame({'t': t, 'glucose': np.ones(t.size) * 180})
-        )[-1]
-    )
-
     # if there has been a main meal, trigger the algorithm
     if last_mealtime > 0:
         
         # get last mealtime bolus (if no bolus, consider when meal was announced)
-        bolus_indices = np.where(bolus[:time_index] > 0)[0]
-
-        if last_mealtime == -1 or len(bolus_indices) == 0:
-            last_mealbolustime = last_mealtime
-        else:
-            nearby_boluses = bolus_indices[np.abs(bolus_indices - last_mealtime) <= 4]
-            last_mealbolustime = nearby_boluses[-1] if len(nearby_boluses) > 0 else last_mealtime
+        last_mealbolustime = events.get_meal_bolustime(last_mealtime, time_index)
             
         if time_index - last_mealbolustime > t_pers and not np.any(bolus[(time_index - int(t_pers)):time_index]):
             # compute dr
-            dr_vec = dynamic_risk(pd.DataFrame({'t': pd.date_range(start=pd.Timestamp.today().normalize(),
-                            periods=len(glucose[:time_index]), freq='5min'), 'glucose': glucose[:time_index]}))
+            dr, dr_slope = dynamic_risk_tail(glucose[:time_index])
             
-            if dr_vec[-1] > dr_threshold:
+            if dr > dr_threshold:
                 # compute iob
                 iob = compute_iob(bolus[:time_index])
                 
@@ -418,13 +348,167 @@ def drCORRECT(
                     dss.correction_boluses_handler_params['first_bolus_after_meal'] = False
                     
                 else:
-                    if np.diff(dr_vec)[-1] > 0:
+                    if dr_slope > 0:
                         # ...give a bolus
                         cb = np.max([0, (glucose[time_index] - gt) / cf - iob])
     
     return cb, dss
 
 
+def prepare_drcorrect_params(params: dict | None = None) -> dict:
+    """
+    Resolve the drCORRECT parameters that stay constant during a replay (t_pers and dr_threshold), 
+    filling in the defaults, so that the handler does not recompute them at every step.
+    The returned dict can be passed as correction_boluses_handler_params.
+    """
+    
+    prepared = dict(params) if params is not None else {}
+    prepared['t_pers'] = prepared.get('t_pers', 120)
+    if 'dr_threshold' not in prepared:
+        prepared['dr_threshold'] = DR_THRESHOLD
+    prepared['prepared'] = True
+    
+    return prepared
+
+
+def dynamic_risk_tail(glucose: np.ndarray, ts: float = 5, maximum_amplification: float = 2.5, 
+                      amplification_rapidity: float = 2., maximum_damping: float = 0.6) -> tuple[float, float]:
+    """
+    Compute the last value of the dynamic risk of glucose and its last increment.
+    Equivalent to dynamic_risk(...)[-1] and np.diff(dynamic_risk(...))[-1] of py_agata (tanh amplification) 
+    on a ts-minute grid, but only the last three samples are used since the risk is pointwise in glucose and 
+    its rate-of-change.
+    """
+    
+    window = glucose[-3:]
+    roc = np.append(0, np.diff(window) / ts)
+    if window.size == glucose.size:
+        # the first sample of the trace has no rate-of-change
+        dr = dynamic_risk_values(window, roc, maximum_amplification, amplification_rapidity, maximum_damping)
+    else:
+        dr = dynamic_risk_values(window[1:], roc[1:], maximum_amplification, amplification_rapidity, maximum_damping)
+    
+    if dr.size < 2:
+        return dr[-1], np.nan
+    
+    return dr[-1], dr[-1] - dr[-2]
+
+
+def dynamic_risk_values(glucose: np.ndarray, roc: np.ndarray, maximum_amplification: float = 2.5, 
+                        amplification_rapidity: float = 2., maximum_damping: float = 0.6) -> np.ndarray:
+    """
+    Pointwise dynamic risk of glucose (mg/dl) given its rate-of-change (mg/dl/min), following py_agata 
+    (S. Guerra et al., Diabetes Technol Ther, 2011) with tanh amplification.
+    """
+    
+    alpha = 1.084
+    beta = 5.381
+    gamma = 1.509
+    dr_delta = (maximum_amplification - maximum_damping) / 2
+    dr_beta = dr_delta + maximum_damping
+    dr_gamma = np.arctanh(complex((1 - dr_beta) / dr_delta, 0))
+    
+    # Symmetrization and static risk
+    f = gamma * (np.log(glucose) ** alpha - beta)
+    rl = 10 * (f ** 2)
+    rl[f > 0] = 0
+    rh = 10 * (f ** 2)
+    rh[f < 0] = 0
+    sr = rh - rl
+    
+    # Rate-of-change amplification
+    dr_over_dg = np.divide(10 * (gamma**2) * 2 * alpha * (np.log(glucose)**(2 * alpha - 1) - beta * np.log(glucose)**(alpha - 1)), glucose)
+    modulation_factor = np.real(dr_delta*np.tanh(amplification_rapidity * np.multiply(dr_over_dg, roc) + dr_gamma)) + dr_beta
+    
+    return np.multiply(sr, modulation_factor)
+
+
+# Default drCORRECT threshold: dynamic risk of a steady glucose of 180 mg/dl
+DR_THRESHOLD = dynamic_risk_values(np.array([180.]), np.zeros(1))[0]
+
+
+class EventIndex:
+    """
+    Sorted positions of the main meals (B, L, D) and of the boluses of a trace, with O(log n) lookups.
+    The index is filled incrementally: each update only scans the samples added since the previous one.
+    """
+    
+    def __init__(self):
+        self.meals = []
+        self.boluses = []
+        self.scanned = 0
+    
+    def update(self, meal_announcement: np.ndarray, meal_type: np.ndarray, bolus: np.ndarray, time_index: int) -> None:
+        """
+        Add the meals and boluses found in [scanned, time_index). If time_index goes back (e.g., ReplayBG
+        starting a new realization with the same DSS), the index is rebuilt from scratch.
+        """
+        
+        if time_index < self.scanned:
+            self.__init__()
+        if time_index == self.scanned:
+            return
+        
+        start = self.scanned
+        if time_index - start <= 16:
+            # replay step (or a few steps, e.g. open-loop advice at the CGM samples): plain scalar checks are
+            # cheaper than array scans
+            for i in range(start, time_index):
+                if meal_announcement[i] > 0 and meal_type[i] in ('B', 'L', 'D'):
+                    self.meals.append(i)
+                if bolus[i] > 0:
+                    self.boluses.append(i)
+        else:
+            meals = np.flatnonzero(meal_announcement[start:time_index] > 0) + start
+            mask_bld = np.isin(meal_type[meals], ['B', 'L', 'D'])
+            self.meals.extend(meals[mask_bld].tolist())
+            self.boluses.extend((np.flatnonzero(bolus[start:time_index] > 0) + start).tolist())
+        self.scanned = time_index
+    
+    def get_last_mealtime(self, time_index: int) -> int:
+        """
+        Get the index of the last mealtime labeled as B, L or D before time_index (-1 if none).
+        """
+        
+        i = bisect_left(self.meals, time_index)
+        return self.meals[i - 1] if i > 0 else -1
+    
+    def get_meal_bolustime(self, mealtime: int, time_index: int, tolerance: int = 4) -> int:
+        """
+        Get the index of the last bolus before time_index within tolerance minutes of mealtime
+        (mealtime itself if there is none).
+        """
+        
+        lo = bisect_left(self.boluses, mealtime - tolerance)
+        hi = min(bisect_right(self.boluses, mealtime + tolerance), bisect_left(self.boluses, time_index))
+        return self.boluses[hi - 1] if hi > lo else mealtime
+    
+    @classmethod
+    def from_arrays(cls, meal_announcement: np.ndarray, meal_type: np.ndarray, bolus: np.ndarray) -> "EventIndex":
+        """
+        Build the index of a whole trace at once.
+        """
+        
+        index = cls()
+        index.update(meal_announcement, meal_type, bolus, len(bolus))
+        return index
+
+
+def update_event_index(meal_announcement: np.ndarray, meal_type: np.ndarray, bolus: np.ndarray, time_index: int, dss: object) -> EventIndex:
+    """
+    Get the EventIndex stored in the correction_boluses_handler_params memory area (creating it if needed)
+    and bring it up to time_index.
+    """
+    
+    events = dss.correction_boluses_handler_params.get('event_index')
+    if events is None:
+        events = EventIndex()
+        dss.correction_boluses_handler_params['event_index'] = events
+    events.update(meal_announcement, meal_type, bolus, time_index)
+    
+    return events
+
+
 def get_last_mealtime(meal_announcement: np.ndarray, meal_type: np.ndarray, time_index: int) -> int:
     """
     Get the index of the last mealtime labeled as B, L or D before time_index.
@@ -445,13 +529,11 @@ def get_last_mealtime(meal_announcement: np.ndarray, meal_type: np.ndarray, time
         return -1
 
 
-def compute_iob(bolus: np.ndarray) -> np.ndarray:
+def iob_6h_curve(ts: int = 5) -> np.ndarray:
     """
-    Compute insulin on board (IOB) from bolus array using a 6-hour action profile.
+    Build the 6-hour insulin action profile used to compute IOB, sampled every ts minutes.
     """
     
-    ts = 5
-
     k1 = 0.0173
     k2 = 0.0116
     k3 = 6.73
@@ -461,32 +543,106 @@ def compute_iob(bolus: np.ndarray) -> np.ndarray:
     for t in range(0, 360):
         iob_6h_curve[t] = 1 - 0.75 * ((- k3 / (k2 * (k1 - k2)) * (np.exp(-k2 * t / 0.75) - 1) + k3 / (
                     k1 * (k1 - k2)) * (np.exp(-k1 * t / 0.75) - 1)) / 2.4947e4)
-    iob_6h_curve = iob_6h_curve[ts::ts]
+    
+    return iob_6h_curve[ts::ts]
+
+
+# IOB kernel, built once at import time (reversed to match the np.convolve summation order)
+IOB_CURVE = iob_6h_curve()
+IOB_CURVE_REVERSED = np.ascontiguousarray(IOB_CURVE[::-1])
+
 
-    iob = np.convolve(bolus, iob_6h_curve)
-    iob = iob[bolus.shape[0] - 1]
+def compute_iob(bolus: np.ndarray) -> float:
+    """
+    Compute insulin on board (IOB) from bolus array using a 6-hour action profile.
+    Only the last IOB_CURVE.size samples contribute, so the cost does not depend on the length of bolus.
+    """
     
-    return iob
+    n = bolus.shape[0]
+    if n < IOB_CURVE.size:
+        iob = np.convolve(bolus, IOB_CURVE)
+        return iob[n - 1]
+    
+    return np.dot(bolus[n - IOB_CURVE.size:], IOB_CURVE_REVERSED)
+
+
+# Arrow classification: edges of the trend (mg/dl/min) intervals of the arrows -3, ..., 3. The intervals of the
+# even arrows (-2, 0, 2) include both their edges, the others exclude them:
+# (-inf, -3) [-3, -2] (-2, -1) [-1, 1] (1, 2) [2, 3] (3, inf)
+ARROW_EDGES = [-3, -2, -1, 1, 2, 3]
+
+# Aleppo's trend correction (U), one row per arrow (-3, ..., 3) and one column per cf band (see CF_EDGES)
+TREND_CORRECTION = np.array([
+    [-4.5, -3.5, -2.5, -1.5],
+    [-3.5, -2.5, -1.5, -1. ],
+    [-2.5, -1.5, -1. , -0.5],
+    [ 0. ,  0. ,  0. ,  0. ],
+    [+2.5, +1.5, +1. , +0.5],
+    [+3.5, +2.5, +1.5, +1. ],
+    [+4.5, +3.5, +2.5, +1.5],
+])
+_TREND_CORRECTION_ROWS = TREND_CORRECTION.tolist()
+
+# cf bands (mg/dl/U) of the trend correction: cf < 25, 25 <= cf < 50, 50 <= cf < 75, cf >= 75
+CF_EDGES = [25, 50, 75]
 
 
 def get_arrow(current_trend: float) -> int:
     """
-    Scale the current trend (mg/dl/min) into an arrow value according to guidelines.
+    Scale the current trend (mg/dl/min) into an arrow value according to guidelines (see ARROW_EDGES).
     """
+    if current_trend != current_trend:
+        raise ValueError("The trend is NaN.")
     
-    if abs(current_trend) <= 1:
-        scaled_trend = 0
-    elif 1 < current_trend < 2:
-        scaled_trend = 1
-    elif 2 <= current_trend <= 3:
-        scaled_trend = 2
-    elif current_trend >3:
-        scaled_trend = 3
-    elif -2 < current_trend < -1:
-        scaled_trend = -1
-    elif -3 <= current_trend <= -2:
-        scaled_trend = -2
-    elif current_trend < -3:
-        scaled_trend = -3
-
-    return scaled_trend
\ No newline at end of file
+    # an edge belongs to the interval of the even arrow next to it
+    i = bisect_left(ARROW_EDGES, current_trend)
+    if i % 2 == 0:
+        i = bisect_right(ARROW_EDGES, current_trend)
+
+    return i - 3
+
+
+def trend_correction(arrow: int, cf: float) -> float:
+    """
+    Aleppo's trend correction (U) for an arrow and a correction factor (see TREND_CORRECTION).
+    """
+    return _TREND_CORRECTION_ROWS[arrow + 3][bisect_right(CF_EDGES, cf)]
+
+
+def get_arrows(trend: np.ndarray) -> np.ndarray:
+    """
+    Batch version of get_arrow.
+    Args:
+        trend: np.ndarray, trends (mg/dl/min), of any shape
+    Returns:
+        arrow: np.ndarray, arrow of each trend (float, NaN where the trend is NaN)
+    """
+    trend = np.asarray(trend, dtype=float)
+    i = np.searchsorted(ARROW_EDGES, trend, side='left')
+    i = np.where(i % 2 == 0, np.searchsorted(ARROW_EDGES, trend, side='right'), i)
+    return np.where(np.isnan(trend), np.nan, i - 3.)
+
+
+def score_trends(glucose: np.ndarray, cf: float, ts: int = 1) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Arrow and Aleppo's trend correction of every sample of a CGM stream, without replaying it. The trend is the
+    glucose variation over the last 15 minutes, as in the aleppo handler.
+    Args:
+        glucose: np.ndarray, glucose (mg/dl) sampled every ts minutes, 1D or one row per day (along the last axis)
+        cf: float, correction factor (mg/dl/U)
+        ts: int, sampling time (min), a divisor of 15
+    Returns:
+        trend: np.ndarray, trend (mg/dl/min), NaN for the first 15 minutes and where glucose is missing
+        arrow: np.ndarray, arrow of each sample (NaN where the trend is NaN)
+        correction: np.ndarray, trend correction (U) of each sample (NaN where the trend is NaN)
+    """
+    glucose = np.asarray(glucose, dtype=float)
+    lag = 15 // ts
+    trend = np.full(glucose.shape, np.nan)
+    trend[..., lag:] = (glucose[..., lag:] - glucose[..., :-lag]) / 15
+
+    arrow = get_arrows(trend)
+    valid = ~np.isnan(arrow)
+    correction = np.full(glucose.shape, np.nan)
+    correction[valid] = TREND_CORRECTION[arrow[valid].astype(int) + 3, bisect_right(CF_EDGES, cf)]
+    return trend, arrow, correction
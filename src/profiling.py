@@ -0,0 +1,123 @@
+"""
+Opt-in timing and profiling instrumentation of the workflow, emitted as JSON lines.
+"""
+
+import os
+import json
+import time
+import cProfile
+from contextlib import contextmanager
+
+
+# Instrumentation settings (disabled until enable_instrumentation is called)
+_config = {'path': None, 'profile_dir': None}
+
+
+def enable_instrumentation(path: str, profile_dir: str | None = None) -> None:
+    """
+    Enable the instrumentation.
+    Args:
+        path: str, JSON lines file the timings are appended to
+        profile_dir: str, folder of the cProfile stats of the handlers (None to not profile them)
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    if profile_dir is not None:
+        os.makedirs(profile_dir, exist_ok=True)
+    _config['path'] = path
+    _config['profile_dir'] = profile_dir
+
+
+def disable_instrumentation() -> None:
+    """
+    Disable the instrumentation.
+    """
+    _config['path'] = None
+    _config['profile_dir'] = None
+
+
+def is_enabled() -> bool:
+    """
+    Whether the instrumentation is enabled.
+    """
+    return _config['path'] is not None
+
+
+def emit(record: dict) -> None:
+    """
+    Append a record (with timestamp and process id) to the timings file, if the instrumentation is enabled.
+    """
+    if not is_enabled():
+        return
+    line = json.dumps({'time': time.time(), 'pid': os.getpid(), **record}, default=str)
+    with open(_config['path'], 'a') as f:
+        f.write(line + "\n")
+
+
+@contextmanager
+def stage(name: str, **tags):
+    """
+    Time a stage of the workflow and emit it as {'stage': name, 'seconds': ..., **tags}.
+    The yielded dict can be used to add fields to the record.
+    """
+    record = {'stage': name, **tags}
+    tic = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['seconds'] = time.perf_counter() - tic
+        emit(record)
+
+
+class TimedHandler:
+    """
+    Wrapper of a correction boluses handler counting its calls and their cumulative time, optionally
+    profiling them with cProfile. Instances are picklable when the wrapped handler is.
+    """
+
+    def __init__(self, handler: object, profile: bool = False):
+        self.__wrapped__ = handler
+        self.calls = 0
+        self.seconds = 0.
+        self.profiler = cProfile.Profile() if profile else None
+
+    def __call__(self, *args, **kwargs):
+        tic = time.perf_counter()
+        if self.profiler is not None:
+            self.profiler.enable()
+        try:
+            return self.__wrapped__(*args, **kwargs)
+        finally:
+            if self.profiler is not None:
+                self.profiler.disable()
+            self.seconds += time.perf_counter() - tic
+            self.calls += 1
+
+    def __getstate__(self) -> dict:
+        # cProfile.Profile is not picklable
+        state = self.__dict__.copy()
+        state['profiler'] = state['profiler'] is not None
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        profile = state.pop('profiler')
+        self.__dict__.update(state)
+        self.profiler = cProfile.Profile() if profile else None
+
+    def dump_stats(self, name: str) -> str | None:
+        """
+        Save the cProfile stats as <profile_dir>/<name>.prof (None if not profiling).
+        """
+        if self.profiler is None or _config['profile_dir'] is None:
+            return None
+        path = os.path.join(_config['profile_dir'], f"{name}.prof")
+        self.profiler.dump_stats(path)
+        return path
+
+
+def instrument_handler(handler: object) -> object:
+    """
+    Wrap a handler in a TimedHandler if the instrumentation is enabled (profiling it if a profile_dir is set).
+    """
+    if not is_enabled() or handler is None:
+        return handler
+    return TimedHandler(handler, profile=_config['profile_dir'] is not None)
@@ -0,0 +1,159 @@
+"""
+Columnar (Parquet) store of the comparison results of a cohort, partitioned by twinning method: one Parquet
+file per partition, plus the pending files of the traces written since the last compaction.
+"""
+
+import os
+import glob
+import tempfile
+
+import pandas as pd
+
+
+# Single Parquet file of each partition, and folder of the results of the traces not compacted into it yet
+COMPACTED_FILE = "results.parquet"
+PENDING_FOLDER = "pending"
+
+
+def tidy_comparison(df: pd.DataFrame, trace_name: str) -> pd.DataFrame:
+    """
+    Reshape the comparison results of a trace into one row per strategy.
+    Args:
+        df: pd.DataFrame, comparison results (metrics x strategies) as returned by save_comparison
+        trace_name: str, name of the trace
+    Returns:
+        df_tidy: pd.DataFrame, with columns 'trace', 'strategy' and one column per metric
+    """
+    df_tidy = df.T.astype(float).rename_axis('strategy').reset_index()
+    df_tidy.insert(0, 'trace', trace_name)
+    return df_tidy
+
+
+def partition_path(store_folder: str, twinning_method: str) -> str:
+    """
+    Folder of the twinning_method=<method> partition of the store.
+    """
+    return os.path.join(store_folder, f"twinning_method={twinning_method}")
+
+
+def append_results(df: pd.DataFrame, store_folder: str, trace_name: str, twinning_method: str) -> str:
+    """
+    Write the comparison results of a trace to the store. A trace is first written as a small pending file of the
+    twinning_method=<method> partition (pending/<trace>.parquet), written to a temporary file and then renamed:
+    a single Parquet file cannot be appended to by many worker processes at once, while separate files let parallel
+    workers append safely and readers never see partial files. compact_results then merges the pending files into
+    the single file of the partition. Writing a trace again replaces its results.
+    Args:
+        df: pd.DataFrame, comparison results (metrics x strategies) as returned by save_comparison
+        store_folder: str, root folder of the store
+        trace_name: str, name of the trace
+        twinning_method: str, method used for twinning ('map' or 'mcmc')
+    Returns:
+        path: str, path of the written file
+    """
+    pending = os.path.join(partition_path(store_folder, twinning_method), PENDING_FOLDER)
+    os.makedirs(pending, exist_ok=True)
+    path = os.path.join(pending, f"{trace_name}.parquet")
+
+    # temporary files start with '.' so that they are ignored by the loaders
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{trace_name}.", suffix=".tmp", dir=pending)
+    os.close(fd)
+    try:
+        tidy_comparison(df, trace_name).to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    return path
+
+
+def compact_results(store_folder: str, twinning_method: str, row_group_size: int = 100000) -> str | None:
+    """
+    Merge the pending files of a partition into its single Parquet file (the results of a trace in a pending file
+    replace the ones already compacted), then remove the merged pending files. Meant to be run when no worker is
+    writing to the partition (e.g., at the end of run_batch); a pending file rewritten during the compaction is kept.
+    Args:
+        store_folder: str, root folder of the store
+        twinning_method: str, partition to compact
+        row_group_size: int, maximum number of rows of each row group of the compacted file
+    Returns:
+        path: str, path of the compacted file (None if the partition is empty)
+    """
+    partition = partition_path(store_folder, twinning_method)
+    path = os.path.join(partition, COMPACTED_FILE)
+    pending = {p: os.stat(p) for p in _pending_files(partition)}
+    if not pending:
+        return path if os.path.exists(path) else None
+
+    df = _read_partition(partition, list(pending), None)
+    fd, tmp_path = tempfile.mkstemp(prefix=".compacted.", suffix=".tmp", dir=partition)
+    os.close(fd)
+    try:
+        df.to_parquet(tmp_path, index=False, row_group_size=row_group_size)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    for p, stat in pending.items():
+        try:
+            current = os.stat(p)
+        except FileNotFoundError:
+            continue
+        if (current.st_mtime_ns, current.st_size) == (stat.st_mtime_ns, stat.st_size):
+            os.remove(p)
+    return path
+
+
+def load_results(store_folder: str, twinning_method: str | None = None, columns: list[str] | None = None) -> pd.DataFrame:
+    """
+    Load the cohort comparison results from the store: the compacted file of each partition, plus the pending files
+    not compacted yet (see compact_results).
+    Args:
+        store_folder: str, root folder of the store
+        twinning_method: str, partition to load (default: all of them)
+        columns: list, metric columns to load (default: all of them)
+    Returns:
+        df: pd.DataFrame, one row per trace and strategy, with columns 'twinning_method', 'trace', 'strategy' and the metrics
+    """
+    methods = [twinning_method] if twinning_method is not None else sorted(
+        os.path.basename(p)[len("twinning_method="):] for p in glob.glob(os.path.join(store_folder, "twinning_method=*")))
+    if columns is not None:
+        columns = ['trace', 'strategy'] + [c for c in columns if c not in ('trace', 'strategy')]
+
+    frames = []
+    for method in methods:
+        partition = partition_path(store_folder, method)
+        df_method = _read_partition(partition, _pending_files(partition), columns)
+        if df_method is None:
+            continue
+        df_method.insert(0, 'twinning_method', method)
+        frames.append(df_method)
+
+    if not frames:
+        return pd.DataFrame(columns=['twinning_method', 'trace', 'strategy'] + (columns[2:] if columns is not None else []))
+    return pd.concat(frames, ignore_index=True)
+
+
+def _pending_files(partition: str) -> list[str]:
+    """
+    Pending files of a partition (including the per-trace files of stores written before compaction existed).
+    """
+    legacy = [p for p in glob.glob(os.path.join(partition, "*.parquet")) if os.path.basename(p) != COMPACTED_FILE]
+    return sorted(glob.glob(os.path.join(partition, PENDING_FOLDER, "*.parquet")) + legacy)
+
+
+def _read_partition(partition: str, pending: list[str], columns: list[str] | None) -> pd.DataFrame | None:
+    """
+    Results of a partition: the compacted file, with the traces of the pending files replaced by their results.
+    """
+    frames = [pd.read_parquet(p, columns=columns) for p in pending]
+    compacted = os.path.join(partition, COMPACTED_FILE)
+    if os.path.exists(compacted):
+        df = pd.read_parquet(compacted, columns=columns)
+        traces = {trace for frame in frames for trace in frame['trace']}
+        frames.insert(0, df[~df['trace'].isin(traces)])
+    if not frames:
+        return None
+    return pd.concat(frames, ignore_index=True).sort_values(['trace', 'strategy'], ignore_index=True)
@@ -0,0 +1,99 @@
+"""
+Registry of the corrective insulin bolus strategies compared in the replay analysis.
+"""
+
+from src.handlers import drCORRECT, aleppo, prepare_drcorrect_params
+
+
+# Registered strategies, in comparison order (name -> entry)
+STRATEGIES = {}
+
+
+def register_strategy(name: str, handler: object | None, params_builder: object | None = None, save_suffix: str | None = None,
+                      label: str | None = None, plot_label: str | None = None, color: str = 'black', replace: bool = False) -> dict:
+    """
+    Register a corrective strategy so that comparisons, metrics and plots include it.
+    Args:
+        name: str, name of the strategy (key of the comparison results)
+        handler: function, correction boluses handler from src.handlers (None to replay without correction boluses)
+        params_builder: function, params_builder(subject_info, t_pers) returning the correction_boluses_handler_params
+        save_suffix: str, suffix of the replay workspace, may contain '{twinning_method}' (None to not save the workspace)
+        label: str, description used in the logs (default: 'using <name>.')
+        plot_label: str, label used in the plot legends (default: name)
+        color: str, color used in the plots
+        replace: bool, whether to overwrite an already registered strategy with the same name
+    Returns:
+        entry: dict, registered entry
+    """
+    if name in STRATEGIES and not replace:
+        raise ValueError(f"Strategy '{name}' is already registered, use replace=True to overwrite it.")
+
+    STRATEGIES[name] = {
+        'name': name,
+        'handler': handler,
+        'params_builder': params_builder,
+        'save_suffix': save_suffix,
+        'label': label if label is not None else 'using ' + name + '.',
+        'plot_label': plot_label if plot_label is not None else name,
+        'color': color,
+    }
+    return STRATEGIES[name]
+
+
+def unregister_strategy(name: str) -> None:
+    """
+    Remove a strategy from the registry.
+    """
+    del STRATEGIES[name]
+
+
+def build_strategies(subject_info: dict, t_pers: float, twinning_method: str, names: list[str] | None = None) -> list[dict]:
+    """
+    Instantiate registered strategies for a subject.
+    Args:
+        subject_info: dict, subject information
+        t_pers: float, personalized parameter for drCORRECT
+        twinning_method: str, method used for twinning ('map' or 'mcmc')
+        names: list, names of the strategies to build (default: all the registered ones)
+    Returns:
+        strategies: list, one dict per strategy with keys 'name', 'handler' (None for no correction boluses),
+            'params' (correction_boluses_handler_params), 'save_suffix' and 'label' (used in the logs)
+    """
+    if names is None:
+        names = list(STRATEGIES)
+
+    strategies = []
+    for name in names:
+        entry = STRATEGIES[name]
+        strategies.append({
+            'name': name,
+            'handler': entry['handler'],
+            'params': entry['params_builder'](subject_info, t_pers) if entry['params_builder'] is not None else None,
+            'save_suffix': entry['save_suffix'].format(twinning_method=twinning_method) if entry['save_suffix'] is not None else None,
+            'label': entry['label'],
+        })
+    return strategies
+
+
+def aleppo_params(subject_info: dict, t_pers: float) -> dict:
+    """
+    Parameters of the Aleppo guidelines handler.
+    """
+    return {'gt': subject_info['gt'], 'cf': subject_info['cf']}
+
+
+def drcorrect_params(subject_info: dict, t_pers: float) -> dict:
+    """
+    Parameters of the drCORRECT handler, with its constants resolved.
+    """
+    return prepare_drcorrect_params({'gt': subject_info['gt'], 'cf': subject_info['cf'], 't_pers': t_pers})
+
+
+register_strategy('Original data', None,
+                  label='with original CIB.', plot_label='Baseline', color='black')
+register_strategy('Aleppo guidelines', aleppo, aleppo_params,
+                  save_suffix='_aleppo_replay_{twinning_method}',
+                  label="using Aleppo's guidelines.", color='red')
+register_strategy('drCORRECT algorithm', drCORRECT, drcorrect_params,
+                  save_suffix='_drcorrect_replay_{twinning_method}',
+                  label='using drCORRECT algorithm...', color='green')
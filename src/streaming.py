@@ -0,0 +1,278 @@
+"""
+Streaming drCORRECT: a per-patient advisor updated one event at a time with bounded state, and an asyncio service
+multiplexing the advisors of many patients in one process.
+"""
+
+import heapq
+import asyncio
+from bisect import insort
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+from src.handlers import compute_iob, dynamic_risk_tail, prepare_drcorrect_params, IOB_CURVE
+from src.advisor import open_loop_inputs
+from src.analysis import remove_correction_boluses
+
+
+class StreamingAdvisor:
+    """
+    drCORRECT for a single patient, fed with CGM readings, boluses and meals one at a time (times in minutes).
+    Only bounded state is kept: the last glucose readings, the boluses in the IOB window, the last main meal and its
+    bolus, the time of the last bolus and first_bolus_after_meal. As in a replay, the decision at a reading only sees
+    the boluses and meals of the previous minutes, and the suggested correction boluses are considered taken at the
+    next minute (where ReplayBG administers them).
+    Updated at every reading of a sequence, it takes the same decisions as drCORRECT replayed over that sequence.
+    """
+
+    def __init__(self, cf: float = 40, gt: float = 120, t_pers: float = 120, dr_threshold: float | None = None,
+                 record_suggestions: bool = True):
+        """
+        Args:
+            cf: float, correction factor (mg/dl/U)
+            gt: float, glucose target (mg/dl)
+            t_pers: float, personalized parameter (min)
+            dr_threshold: float, dynamic risk threshold (default: see prepare_drcorrect_params)
+            record_suggestions: bool, whether the suggested correction boluses are added to the bolus history (at the next minute)
+        """
+        params = prepare_drcorrect_params({'t_pers': t_pers} if dr_threshold is None else {'t_pers': t_pers, 'dr_threshold': dr_threshold})
+        self.cf = cf
+        self.gt = gt
+        self.t_pers = params['t_pers']
+        self.dr_threshold = params['dr_threshold']
+        self.record_suggestions = record_suggestions
+
+        self.last_mealtime = -1
+        self.last_mealbolustime = None
+        self.last_bolustime = None
+        self.first_bolus_after_meal = True
+
+        self._glucose = deque(maxlen=4)  # readings before the current one (dynamic_risk_tail only uses the last 3)
+        self._iob_boluses = deque()  # (minute, U) of the boluses in the IOB window
+        self._recent_bolustimes = deque(maxlen=16)  # times of the last boluses, to find the bolus of a new meal
+        self._pending = []  # (minute, kind, value, label) of the events not visible yet, sorted by minute
+
+    def add_bolus(self, minute: int, units: float) -> None:
+        """
+        Ingest the insulin (U, not U/min) delivered in a minute, visible from the next minute. As in a replay, a
+        recorded bolus of b U/min is delivered over the yts minutes of its sample: ingest b U at each of them
+        (as trace_events does).
+        """
+        insort(self._pending, (minute, 'bolus', units, None), key=lambda event: event[0])
+
+    def add_meal(self, minute: int, cho: float, label: str) -> None:
+        """
+        Ingest a meal (CHO and label, only B, L and D are main meals), visible from the next minute.
+        """
+        insort(self._pending, (minute, 'meal', cho, label), key=lambda event: event[0])
+
+    def update(self, minute: int, glucose: float) -> float:
+        """
+        Ingest a CGM reading and decide the correction bolus.
+        Args:
+            minute: int, time of the reading (min), increasing
+            glucose: float, glucose (mg/dl)
+        Returns:
+            cb: float, suggested correction bolus (U)
+        """
+        while self._pending and self._pending[0][0] < minute:
+            event_minute, kind, value, label = self._pending.pop(0)
+            if kind == 'bolus':
+                self._record_bolus(event_minute, value)
+            elif value > 0 and label in ('B', 'L', 'D'):
+                self._record_meal(event_minute)
+        while self._iob_boluses and self._iob_boluses[0][0] < minute - IOB_CURVE.size:
+            self._iob_boluses.popleft()
+
+        cb = self._decide(minute, glucose)
+
+        self._glucose.append(glucose)
+        if cb > 0 and self.record_suggestions:
+            self.add_bolus(minute + 1, cb)
+        return cb
+
+    def _decide(self, minute: int, glucose: float) -> float:
+        # same checks as drCORRECT, in the same order
+        if self.last_mealtime <= 0 or not self._glucose:
+            return 0
+        last_mealbolustime = self.last_mealtime if self.last_mealbolustime is None else self.last_mealbolustime
+        if minute - last_mealbolustime <= self.t_pers:
+            return 0
+        if self.last_bolustime is not None and self.last_bolustime >= minute - int(self.t_pers):
+            return 0
+
+        dr, dr_slope = dynamic_risk_tail(np.array(self._glucose))
+        if dr <= self.dr_threshold:
+            return 0
+
+        if self.first_bolus_after_meal:
+            self.first_bolus_after_meal = False
+        elif not dr_slope > 0:
+            return 0
+        return np.max([0, (glucose - self.gt) / self.cf - self._iob(minute)])
+
+    def _iob(self, minute: int) -> float:
+        # bolus history of the last IOB_CURVE.size minutes, as seen by compute_iob in a replay
+        n = min(minute, IOB_CURVE.size)
+        bolus = np.zeros(n)
+        for bolustime, units in self._iob_boluses:
+            if bolustime >= minute - n:
+                bolus[bolustime - minute + n] += units
+        return compute_iob(bolus)
+
+    def _record_bolus(self, minute: int, units: float) -> None:
+        if units == 0:
+            return
+        self._iob_boluses.append((minute, units))
+        self.last_bolustime = minute
+        if units > 0:
+            self._recent_bolustimes.append(minute)
+            if self.last_mealtime >= 0 and abs(minute - self.last_mealtime) <= 4:
+                self.last_mealbolustime = minute
+
+    def _record_meal(self, minute: int) -> None:
+        if minute != self.last_mealtime:
+            self.first_bolus_after_meal = True
+        self.last_mealtime = minute
+        self.last_mealbolustime = None
+        for bolustime in self._recent_bolustimes:
+            if minute - 4 <= bolustime:
+                self.last_mealbolustime = bolustime
+
+
+class AdvisorService:
+    """
+    asyncio front end multiplexing the streaming advisors of many patients in one event loop.
+    Events are dicts with keys 'patient', 'type' ('cgm', 'bolus' or 'meal'), 'minute' and 'glucose' (cgm),
+    'units' (bolus) or 'cho' and 'label' (meal). Each suggested correction bolus is put in the decisions queue as
+    {'patient', 'minute', 'glucose', 'cb'}.
+    """
+
+    def __init__(self, maxsize: int = 0):
+        """
+        Args:
+            maxsize: int, size of the events and decisions queues (0 for unbounded)
+        """
+        self.advisors = {}
+        self.events = asyncio.Queue(maxsize)
+        self.decisions = asyncio.Queue(maxsize)
+
+    def add_patient(self, patient: object, **advisor_kwargs) -> StreamingAdvisor:
+        """
+        Create the advisor of a patient (see StreamingAdvisor for the options).
+        """
+        self.advisors[patient] = StreamingAdvisor(**advisor_kwargs)
+        return self.advisors[patient]
+
+    def remove_patient(self, patient: object) -> None:
+        """
+        Drop the advisor of a patient.
+        """
+        del self.advisors[patient]
+
+    def handle(self, event: dict) -> dict | None:
+        """
+        Process an event synchronously.
+        Returns:
+            decision: dict, decision taken at a CGM reading (None for boluses and meals)
+        """
+        advisor = self.advisors[event['patient']]
+        if event['type'] == 'cgm':
+            cb = advisor.update(event['minute'], event['glucose'])
+            return {'patient': event['patient'], 'minute': event['minute'], 'glucose': event['glucose'], 'cb': cb}
+        if event['type'] == 'bolus':
+            advisor.add_bolus(event['minute'], event['units'])
+        elif event['type'] == 'meal':
+            advisor.add_meal(event['minute'], event['cho'], event['label'])
+        else:
+            raise ValueError(f"Unknown event type '{event['type']}'.")
+        return None
+
+    async def submit(self, event: dict) -> None:
+        """
+        Queue an event.
+        """
+        await self.events.put(event)
+
+    async def serve(self) -> None:
+        """
+        Process the queued events until cancelled.
+        """
+        while True:
+            event = await self.events.get()
+            try:
+                decision = self.handle(event)
+                if decision is not None and decision['cb'] > 0:
+                    await self.decisions.put(decision)
+            finally:
+                self.events.task_done()
+
+
+def trace_events(data: pd.DataFrame, patient: object, step: int = 5, remove_corrections: bool = True) -> list[dict]:
+    """
+    Events of a recorded trace for AdvisorService, in chronological order, on the one-minute grid of open_loop_inputs:
+    the recorded meals, the recorded boluses (one event per minute of their yts-minute delivery, in U) and a CGM
+    reading every step minutes.
+    Args:
+        data: pd.DataFrame, recorded data (e.g., from load_trace)
+        patient: object, identifier of the patient
+        step: int, minutes between two CGM readings (1 to match a replay of drCORRECT)
+        remove_corrections: bool, whether to remove the recorded correction boluses first (see remove_correction_boluses)
+    Returns:
+        events: list, events of the trace
+    """
+    if remove_corrections:
+        data = remove_correction_boluses(data)
+    inputs = open_loop_inputs(data)
+
+    events = []
+    for minute in range(inputs['glucose'].size):
+        if minute % step == 0:
+            events.append({'patient': patient, 'type': 'cgm', 'minute': minute, 'glucose': inputs['glucose'][minute]})
+        if inputs['meal_announcement'][minute] != 0:
+            events.append({'patient': patient, 'type': 'meal', 'minute': minute,
+                           'cho': inputs['meal_announcement'][minute], 'label': inputs['meal_type'][minute]})
+        if inputs['bolus'][minute] != 0:
+            events.append({'patient': patient, 'type': 'bolus', 'minute': minute, 'units': inputs['bolus'][minute]})
+    return events
+
+
+async def replay_traces(traces: dict, step: int = 5, remove_corrections: bool = True, maxsize: int = 1024) -> pd.DataFrame:
+    """
+    Replay recorded traces through an AdvisorService, interleaving the events of all the patients by time.
+    Args:
+        traces: dict, patient -> (data, subject_info, t_pers)
+        step: int, minutes between two CGM readings (see trace_events)
+        remove_corrections: bool, whether to remove the recorded correction boluses first
+        maxsize: int, size of the service queues
+    Returns:
+        decisions: pd.DataFrame, suggested correction boluses with columns 'patient', 'minute', 't', 'glucose' and 'cb'
+    """
+    service = AdvisorService(maxsize)
+    starts = {}
+    streams = []
+    for patient, (data, subject_info, t_pers) in traces.items():
+        service.add_patient(patient, cf=subject_info['cf'], gt=subject_info['gt'], t_pers=t_pers)
+        starts[patient] = data['t'].iloc[0]
+        streams.append(trace_events(data, patient, step, remove_corrections))
+
+    decisions = []
+
+    async def collect():
+        while True:
+            decisions.append(await service.decisions.get())
+
+    tasks = [asyncio.create_task(service.serve()), asyncio.create_task(collect())]
+    for event in heapq.merge(*streams, key=lambda event: event['minute']):
+        await service.submit(event)
+    await service.events.join()
+    while not service.decisions.empty():
+        await asyncio.sleep(0)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    df = pd.DataFrame(decisions, columns=['patient', 'minute', 'glucose', 'cb'])
+    df.insert(2, 't', [starts[patient] + pd.Timedelta(minutes=minute) for patient, minute in zip(df['patient'], df['minute'])])
+    return df
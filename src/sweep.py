@@ -0,0 +1,125 @@
+"""
+Parameter sweeps of the drCORRECT algorithm on a single trace using a worker pool.
+"""
+
+import itertools
+import traceback
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from src.handlers import drCORRECT, prepare_drcorrect_params
+from src.analysis import remove_correction_boluses, replay_strategy
+from src.utils import compute_metrics
+
+
+# Replay context shared by all the grid points evaluated by a worker (set once by _init_worker)
+_worker_context = {}
+
+
+def drcorrect_grid(subject_info: dict, t_pers: list[float], dr_threshold: list[float | None] | None = None,
+                   gt: list[float] | None = None, cf: list[float] | None = None) -> list[dict]:
+    """
+    Build the cartesian grid of drCORRECT settings to evaluate.
+    Args:
+        subject_info: dict, subject information (gt and cf used when no grid is given)
+        t_pers: list, values of t_pers
+        dr_threshold: list, values of dr_threshold (None for the default threshold)
+        gt: list, values of the glucose target (default: subject's gt)
+        cf: list, values of the correction factor (default: subject's cf)
+    Returns:
+        grid: list, one dict per grid point with keys 't_pers', 'dr_threshold', 'gt' and 'cf'
+    """
+    dr_threshold = [None] if dr_threshold is None else dr_threshold
+    gt = [subject_info['gt']] if gt is None else gt
+    cf = [subject_info['cf']] if cf is None else cf
+
+    return [{'t_pers': t, 'dr_threshold': dr, 'gt': g, 'cf': c}
+            for t, dr, g, c in itertools.product(t_pers, dr_threshold, gt, cf)]
+
+
+def _grid_point_strategy(point: dict) -> dict:
+    """
+    Build the drCORRECT strategy (see src.strategies.build_strategies) of a grid point.
+    """
+    params = {'gt': point['gt'], 'cf': point['cf'], 't_pers': point['t_pers']}
+    if point['dr_threshold'] is not None:
+        params['dr_threshold'] = point['dr_threshold']
+
+    name = f"drCORRECT (t_pers={point['t_pers']}, dr_threshold={point['dr_threshold']}, gt={point['gt']}, cf={point['cf']})"
+    return {'name': name, 'handler': drCORRECT, 'params': prepare_drcorrect_params(params),
+            'save_suffix': None, 'label': 'using ' + name + '.'}
+
+
+def _init_worker(rbg: object, data: pd.DataFrame, subject_info: dict, twinning_method: str, save_name: str) -> None:
+    """
+    Store the replay context used by a worker for all the grid points it evaluates.
+    """
+    global _worker_context
+    _worker_context = {'rbg': rbg, 'data': data, 'subject_info': subject_info,
+                       'twinning_method': twinning_method, 'save_name': save_name}
+
+
+def _evaluate_point(point: dict) -> dict:
+    """
+    Replay a grid point inside a worker and compute its metrics.
+    """
+    result = replay_strategy(_worker_context['rbg'], _worker_context['data'], _worker_context['subject_info'],
+                             _worker_context['twinning_method'], _worker_context['save_name'], _grid_point_strategy(point))
+    return compute_metrics(result)
+
+
+def sweep_drcorrect(rbg: object, data: pd.DataFrame, subject_info: dict, twinning_method: str, save_name: str, trace_name: str,
+                    t_pers: list[float], dr_threshold: list[float | None] | None = None, gt: list[float] | None = None, cf: list[float] | None = None,
+                    executor: str = 'process', max_workers: int | None = None) -> pd.DataFrame:
+    """
+    Evaluate drCORRECT over a grid of settings on a single trace. The twin and the data without correction boluses are
+    prepared once and shared by the workers; a failing grid point is reported and skipped.
+    Args:
+        rbg: ReplayBG object, instantiated digital twin tool
+        data: pd.DataFrame, original data
+        subject_info: dict, subject information
+        twinning_method: str, method used for twinning ('map' or 'mcmc')
+        save_name: str, name of the twin
+        trace_name: str, name of the trace
+        t_pers: list, values of t_pers
+        dr_threshold: list, values of dr_threshold (None for the default threshold)
+        gt: list, values of the glucose target (default: subject's gt)
+        cf: list, values of the correction factor (default: subject's cf)
+        executor: str, 'thread' or 'process'
+        max_workers: int, number of parallel workers (default: number of CPUs)
+    Returns:
+        df: pd.DataFrame, one row per grid point with the settings, the metrics and a 'status' column
+    """
+    if executor == 'thread':
+        pool_class = ThreadPoolExecutor
+    elif executor == 'process':
+        pool_class = ProcessPoolExecutor
+    else:
+        raise ValueError(f"Unknown executor '{executor}', use 'thread' or 'process'.")
+
+    grid = drcorrect_grid(subject_info, t_pers, dr_threshold, gt, cf)
+    if not grid:
+        raise ValueError("Empty grid of drCORRECT settings.")
+    data_no_cib = remove_correction_boluses(data)
+
+    print("Sweeping drCORRECT settings on Tidepool " + trace_name + " data over " + str(len(grid)) + " grid points.")
+    rows = []
+    with pool_class(max_workers=max_workers, initializer=_init_worker,
+                    initargs=(rbg, data_no_cib, subject_info, twinning_method, save_name)) as pool:
+        futures = {pool.submit(_evaluate_point, point): i for i, point in enumerate(grid)}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                metrics = future.result()
+            except Exception:
+                print(f"Grid point {grid[i]} for {trace_name} failed:\n{traceback.format_exc()}")
+                rows.append({'point': i, **grid[i], 'status': 'failed'})
+                continue
+            rows.append({'point': i, **grid[i], **metrics, 'status': 'ok'})
+
+    df = pd.DataFrame(rows).sort_values('point', ignore_index=True).drop(columns='point')
+    df.insert(0, 'trace', trace_name)
+    df = df[[c for c in df.columns if c != 'status'] + ['status']]
+
+    return df
@@ -1,12 +1,44 @@
 """
-Utility for performing a single-day digital twinning run.
+Utility for performing a single-day digital twinning run, and a resumable cohort twinning pipeline.
 """
 
+import os
+import json
 import time
+import pickle
+import datetime
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-def twin_day(rbg: object, twinning_method: str, data: object, subject_info: dict, save_name: str, trace_name: str) -> None:
+import numpy as np
+import emcee
+
+from py_replay_bg.py_replay_bg import ReplayBG
+
+from src.utils import load_trace
+from src.batch import discover_traces
+
+
+# Burn-in steps ReplayBG runs (and discards) before the production steps of every MCMC twinning run
+BURN_IN_STEPS = 10000
+
+# ReplayBG instance owned by each worker process (created once by _init_worker)
+_worker_rbg = None
+_worker_config = {}
+
+
+def twin_day(rbg: object, twinning_method: str, data: object, subject_info: dict, save_name: str, trace_name: str,
+             parallelize: bool = True, n_processes: int | None = None, n_steps: int = 50000, max_seconds: float | None = None,
+             adaptive: bool = False, min_steps: int = 5000, r_hat_threshold: float = 1.1, min_ess: float = 1000) -> dict:
     """
     Perform single-day digital twinning using ReplayBG.
+    In adaptive mode (MCMC only), the twin is first run with min_steps production steps and the steps are doubled
+    until the chain diagnostics (see chain_diagnostics) pass. Every run starts from scratch and repeats the
+    BURN_IN_STEPS burn-in, so the runs are capped to never cost more, in total, than a single run with n_steps
+    (BURN_IN_STEPS + n_steps steps): the last run is shortened to the steps left, and no run is started if it would
+    not be longer than the previous one. max_seconds is only checked between runs: a new run is not started if it is
+    expected to end after max_seconds, but a running twin is never interrupted. The budget actually used is also
+    saved in results/<twinning_method>/<twinning_method>_<save_name>_budget.json.
     Args:
         rbg: ReplayBG object, instantiated ReplayBG digital twin tool
         twinning_method: str, method for twinning ('map' or 'mcmc')
@@ -14,19 +46,226 @@ def twin_day(rbg: object, twinning_method: str, data: object, subject_info: dict
         subject_info: dict, subject information including bw and u2ss
         save_name: str, name to save the twin
         trace_name: str, name of the trace for logging
+        parallelize: bool, whether ReplayBG parallelizes the twinning procedure
+        n_processes: int, number of processes used by ReplayBG if parallelize (default: number of CPUs)
+        n_steps: int, number of MCMC production steps of the fixed budget, which also caps the total cost of the
+            adaptive runs (ignored if twinning_method='map')
+        max_seconds: float, wall-clock budget checked between the adaptive runs (None for no limit, only allowed
+            in adaptive mode)
+        adaptive: bool, whether to stop early once the chain converges (ignored if twinning_method='map')
+        min_steps: int, number of MCMC production steps of the first adaptive run
+        r_hat_threshold: float, maximum Gelman-Rubin statistic for convergence
+        min_ess: float, minimum effective sample size for convergence
     Returns:
-        None
+        budget: dict, with keys 'status' ('finished' for a fixed budget, 'converged' or 'exhausted' in adaptive
+            mode), 'n_steps' (steps of the saved twin), 'total_steps' (burn-in and production steps of all the runs),
+            'seconds' (total duration), 'converged' (None if not checked), 'r_hat', 'ess' and 'runs' (steps and
+            duration of each run)
     """
+    adaptive = adaptive and twinning_method == 'mcmc'
+    if max_seconds is not None and not adaptive:
+        raise ValueError("max_seconds is only enforced between the runs of the adaptive MCMC twinning (adaptive=True, twinning_method='mcmc').")
+    
     print("Twinning Tidepool " + trace_name + " data using " + twinning_method + " method.")
     
-    # Run twinning procedure
-    tic = time.perf_counter()
-    rbg.twin(data=data, bw=subject_info['bw'], save_name=save_name,
-             twinning_method=twinning_method,
-             n_steps=50000, # ignored if twinning_method='map'
-             parallelize=True, 
-             u2ss=subject_info['u2ss'])
-    toc = time.perf_counter()
+    # the budget file marks a finished twinning (see twin_finished): drop the one of a previous twinning, if any,
+    # so that an interrupted run does not look finished
+    path = budget_path(rbg.environment.replay_bg_path, twinning_method, save_name)
+    if os.path.exists(path):
+        os.remove(path)
+    
+    steps = min(min_steps, n_steps) if adaptive else n_steps
+    max_total_steps = BURN_IN_STEPS + n_steps
+    budget = {'status': None, 'n_steps': steps, 'total_steps': 0, 'seconds': 0., 'converged': None, 'r_hat': None, 'ess': None, 'runs': []}
+    
+    while True:
+        # Run twinning procedure
+        tic = time.perf_counter()
+        rbg.twin(data=data, bw=subject_info['bw'], save_name=save_name,
+                 twinning_method=twinning_method,
+                 n_steps=steps, # ignored if twinning_method='map'
+                 save_chains=adaptive,
+                 parallelize=parallelize,
+                 n_processes=n_processes,
+                 u2ss=subject_info['u2ss'])
+        toc = time.perf_counter()
+        budget['n_steps'] = steps
+        budget['total_steps'] += BURN_IN_STEPS + steps if twinning_method == 'mcmc' else 0
+        budget['seconds'] += toc - tic
+        budget['runs'].append({'n_steps': steps, 'seconds': toc - tic})
+        
+        if not adaptive:
+            break
+        
+        with open(twin_path(rbg.environment.replay_bg_path, twinning_method, save_name), 'rb') as f:
+            draws = pickle.load(f)['draws']
+        r_hat, ess = chain_diagnostics(draws)
+        budget['r_hat'], budget['ess'] = r_hat, ess
+        budget['converged'] = bool(r_hat < r_hat_threshold and ess >= min_ess)
+        print(f"Twinning of {trace_name} with {steps} steps: R-hat {r_hat:0.3f}, ESS {ess:0.0f}.")
+        
+        next_steps = min(2 * steps, max_total_steps - budget['total_steps'] - BURN_IN_STEPS)
+        if budget['converged']:
+            break
+        if next_steps <= steps:
+            print(f"Twinning of {trace_name} stopped: a longer run would exceed the cost of {n_steps} steps.")
+            break
+        if max_seconds is not None and budget['seconds'] + (toc - tic) * (BURN_IN_STEPS + next_steps) / (BURN_IN_STEPS + steps) > max_seconds:
+            print(f"Twinning of {trace_name} stopped: the next run would exceed the {max_seconds:0.0f} s budget.")
+            break
+        steps = next_steps
+    
+    budget['status'] = 'finished' if not adaptive else 'converged' if budget['converged'] else 'exhausted'
+    with open(path, 'w') as f:
+        json.dump(budget, f, indent=2)
+    
+    print(f"Single-day twinning with {twinning_method} for {trace_name} data completed in {budget['seconds']:0.3f} seconds.\n")
+    return budget
+
+
+def chain_diagnostics(draws: dict) -> tuple[float, float]:
+    """
+    Convergence diagnostics of the MCMC chains saved by ReplayBG (save_chains=True).
+    The flat chain of each parameter is split back into one chain per walker (ReplayBG uses 50 walkers per parameter).
+    Args:
+        draws: dict, draws of the twin, with a 'chain' for each parameter
+    Returns:
+        r_hat: float, worst (largest) Gelman-Rubin statistic across parameters, computed between walkers
+        ess: float, worst (smallest) effective sample size across parameters
+    """
+    n_walkers = 50 * len(draws)
+    r_hat, ess = [], []
+    for param in draws.values():
+        chain = np.asarray(param['chain']).reshape(-1, n_walkers)
+        n = chain.shape[0]
+        
+        # between- and within-walker variances
+        b = n * np.var(chain.mean(axis=0), ddof=1)
+        w = np.mean(np.var(chain, axis=0, ddof=1))
+        r_hat.append(np.sqrt(((n - 1) / n * w + b / n) / w))
+        
+        tau = emcee.autocorr.integrated_time(chain, quiet=True)[0]
+        ess.append(chain.size / tau)
     
-    print(f"Single-day twinning with {twinning_method} for {trace_name} data completed in {toc - tic:0.3f} seconds.\n")
-    return
\ No newline at end of file
+    return float(np.max(r_hat)), float(np.min(ess))
+
+
+def twin_path(save_folder: str, twinning_method: str, save_name: str) -> str:
+    """
+    Path of the twin saved by ReplayBG.
+    """
+    return os.path.join(save_folder, "results", twinning_method, f"{twinning_method}_{save_name}.pkl")
+
+
+def budget_path(save_folder: str, twinning_method: str, save_name: str) -> str:
+    """
+    Path of the budget of a twinning, saved by twin_day once the twinning is over.
+    """
+    return os.path.join(save_folder, "results", twinning_method, f"{twinning_method}_{save_name}_budget.json")
+
+
+def twin_finished(save_folder: str, twinning_method: str, save_name: str) -> bool:
+    """
+    Whether a twinning is over, i.e. its twin and budget exist and the budget is finished, converged or exhausted.
+    The twin saved after each adaptive run is not enough: the twinning may have been interrupted before converging.
+    """
+    try:
+        with open(budget_path(save_folder, twinning_method, save_name)) as f:
+            status = json.load(f).get('status', 'finished')
+    except (FileNotFoundError, json.JSONDecodeError):
+        return False
+    return status in ('finished', 'converged', 'exhausted') and os.path.exists(twin_path(save_folder, twinning_method, save_name))
+
+
+def _init_worker(data_folder: str, save_folder: str, twinning_method: str, parallelize: bool, n_processes: int, verbose: bool,
+                 twin_kwargs: dict) -> None:
+    """
+    Instantiate the ReplayBG object used by a worker for all the traces it twins.
+    """
+    global _worker_rbg, _worker_config
+    _worker_rbg = ReplayBG(
+        blueprint="multi-meal", save_folder=save_folder,
+        yts=5,
+        seed=1,
+        verbose=verbose, plot_mode=False
+    )
+    _worker_config = {'data_folder': data_folder, 'twinning_method': twinning_method,
+                      'parallelize': parallelize, 'n_processes': n_processes, 'twin_kwargs': twin_kwargs}
+
+
+def _twin_trace(trace_name: str) -> dict:
+    """
+    Twin a single trace inside a worker.
+    Args:
+        trace_name: str, name of the trace
+    Returns:
+        budget: dict, budget used by the twinning (see twin_day)
+    """
+    data, subject_info = load_trace(trace_name, _worker_config['data_folder'])
+    return twin_day(_worker_rbg, _worker_config['twinning_method'], data, subject_info, "cib_comparison_tidepool_" + trace_name, trace_name,
+                    parallelize=_worker_config['parallelize'], n_processes=_worker_config['n_processes'], **_worker_config['twin_kwargs'])
+
+
+def twin_cohort(data_folder: str, save_folder: str, twinning_method: str = 'mcmc', trace_names: list[str] | None = None,
+                cores_per_twin: int | None = None, max_workers: int | None = None, verbose: bool = False, **twin_kwargs) -> list[dict]:
+    """
+    Twin many traces in parallel, skipping the ones whose twinning is over (see twin_finished), so that an
+    interrupted run can be resumed. The status of each trace is appended to results/<twinning_method>/twinning_manifest.jsonl as soon as
+    it is known. A failing trace is reported and skipped.
+    Args:
+        data_folder: str, folder containing Tidepool_<name>.csv files
+        save_folder: str, ReplayBG save folder (twins are saved in results/<twinning_method>/)
+        twinning_method: str, method used for twinning ('map' or 'mcmc')
+        trace_names: list, traces to twin (default: all the traces found in data_folder)
+        cores_per_twin: int, processes used by ReplayBG for each twin (default: number of CPUs)
+        max_workers: int, number of traces twinned at the same time (default: number of CPUs // cores_per_twin)
+        verbose: bool, ReplayBG verbosity in the workers
+        twin_kwargs: MCMC budget options passed to twin_day (n_steps, max_seconds, adaptive, min_steps, r_hat_threshold, min_ess)
+    Returns:
+        manifest: list, one dict per trace with keys 'trace', 'status' ('ok', 'skipped' or 'failed'), 'seconds',
+            'n_steps', 'converged', 'error' and 'finished'
+    """
+    if trace_names is None:
+        trace_names = discover_traces(data_folder)
+    n_cpus = os.cpu_count() or 1
+    cores_per_twin = n_cpus if cores_per_twin is None else cores_per_twin
+    max_workers = max(1, n_cpus // cores_per_twin) if max_workers is None else max_workers
+
+    manifest_path = os.path.join(save_folder, "results", twinning_method, "twinning_manifest.jsonl")
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+
+    def record(entry):
+        entry['finished'] = datetime.datetime.now().isoformat(timespec='seconds')
+        with open(manifest_path, 'a') as f:
+            f.write(json.dumps(entry) + "\n")
+        manifest.append(entry)
+
+    manifest = []
+    todo = []
+    for trace_name in trace_names:
+        if twin_finished(save_folder, twinning_method, "cib_comparison_tidepool_" + trace_name):
+            record({'trace': trace_name, 'status': 'skipped', 'seconds': None, 'n_steps': None, 'converged': None, 'error': None})
+        else:
+            todo.append(trace_name)
+
+    print(f"Twinning {len(todo)} traces ({len(trace_names) - len(todo)} already twinned) with {max_workers} workers "
+          f"of {cores_per_twin} processes.")
+    if not todo:
+        return manifest
+
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                             initargs=(data_folder, save_folder, twinning_method, cores_per_twin > 1, cores_per_twin, verbose, twin_kwargs)) as executor:
+        futures = {executor.submit(_twin_trace, trace_name): trace_name for trace_name in todo}
+        for future in as_completed(futures):
+            trace_name = futures[future]
+            try:
+                budget = future.result()
+            except Exception:
+                error = traceback.format_exc()
+                print(f"Twinning of {trace_name} failed:\n{error}")
+                record({'trace': trace_name, 'status': 'failed', 'seconds': None, 'n_steps': None, 'converged': None, 'error': error})
+                continue
+            record({'trace': trace_name, 'status': 'ok', 'seconds': budget['seconds'], 'n_steps': budget['n_steps'],
+                    'converged': budget['converged'], 'error': None})
+
+    return manifest
@@ -3,41 +3,105 @@ Utility functions.
 """
 
 import os
+import glob
+import tempfile
+from collections import OrderedDict
 import pandas as pd
 import pickle
 import numpy as np
 import matplotlib.pyplot as plt
 
-from py_agata.time_in_ranges import time_in_target, time_in_hyperglycemia, time_in_hypoglycemia
-from py_agata.risk import gri
-from py_agata.variability import mean_glucose, cv_glucose, std_glucose, std_glucose_roc
+from src.store import append_results
 
 
-def load_example_data(name: str) -> pd.DataFrame:
+# Default folder of the Tidepool_<name>.csv files (data/ of the repository, independent of the working directory)
+DATA_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+
+# Columns of the Tidepool files used for replay (data) and for the subject information, with their types
+DATA_DTYPES = {'glucose': 'float64', 'basal': 'float64', 'bolus': 'float64', 'cho': 'float64', 'bolus_label': 'object', 'cho_label': 'object'}
+SUBJECT_DTYPES = {'bolus_cr': 'float64', 'bolus_cf': 'float64', 'bolus_bg_target': 'float64'}
+
+
+def load_trace(name: str, data_folder: str | None = None, cache_folder: str | None = None) -> tuple[pd.DataFrame, dict]:
     """
-    Load CGM data from CSV file.
+    Load the data and the subject information of a trace, parsing Tidepool_<name>.csv only once and reading
+    only the needed columns with explicit types.
     Args:
         name: str, name of the trace (used to find the correct file)
+        data_folder: str, folder containing the Tidepool_<name>.csv files (default: DATA_FOLDER)
+        cache_folder: str, folder of the Parquet copies of the parsed files, reused while the CSV file is not 
+            modified (None to always parse the CSV file)
     Returns:
-        df: pd.DataFrame, loaded data with 't' as datetime index
+        df: pd.DataFrame, loaded data with 't' as datetime
+        subject_info: dict, subject information (see subject_info_from_data)
+    """
+    data_folder = DATA_FOLDER if data_folder is None else data_folder
+    data_path = os.path.join(data_folder, f"Tidepool_{name}.csv")
+    
+    if cache_folder is None:
+        df = read_trace_csv(data_path)
+    else:
+        # the modification time of the CSV file is part of the name of its cached copy
+        cache_path = os.path.join(cache_folder, f"Tidepool_{name}.{os.stat(data_path).st_mtime_ns}.parquet")
+        if os.path.exists(cache_path):
+            df = pd.read_parquet(cache_path).astype({**DATA_DTYPES, **SUBJECT_DTYPES})
+        else:
+            df = read_trace_csv(data_path)
+            os.makedirs(cache_folder, exist_ok=True)
+            for stale_path in glob.glob(os.path.join(cache_folder, f"Tidepool_{name}.*.parquet")):
+                os.remove(stale_path)
+            fd, tmp_path = tempfile.mkstemp(prefix=f".Tidepool_{name}.", suffix=".tmp", dir=cache_folder)
+            os.close(fd)
+            df.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, cache_path)
+    
+    subject_info = subject_info_from_data(df)
+    
+    return df.drop(columns=list(SUBJECT_DTYPES)), subject_info
+
+
+def read_trace_csv(data_path: str) -> pd.DataFrame:
+    """
+    Parse the columns of a Tidepool CSV file listed in DATA_DTYPES and SUBJECT_DTYPES.
     """
-    data_path = os.path.join("data", f"Tidepool_{name}.csv")
-    df = pd.read_csv(data_path)
+    dtypes = {**DATA_DTYPES, **SUBJECT_DTYPES}
+    df = pd.read_csv(data_path, usecols=['t'] + list(dtypes), dtype=dtypes)
     df['t'] = pd.to_datetime(df['t'])
     return df
 
 
-def load_subject_info(name: str) -> dict:
+def load_example_data(name: str, data_folder: str | None = None) -> pd.DataFrame:
+    """
+    Load CGM data from CSV file.
+    Args:
+        name: str, name of the trace (used to find the correct file)
+        data_folder: str, folder containing the Tidepool_<name>.csv files (default: DATA_FOLDER)
+    Returns:
+        df: pd.DataFrame, loaded data with 't' as datetime index
+    """
+    return load_trace(name, data_folder)[0]
+
+
+def load_subject_info(name: str, data_folder: str | None = None) -> dict:
     """
     Retrieve subject information from CSV file.
     Args:
         name: str, name of the trace (used to find the correct file)
+        data_folder: str, folder containing the Tidepool_<name>.csv files (default: DATA_FOLDER)
+    Returns:
+        dict: subject information including cf, gt, cr, bw, and u2ss
+    """
+    return load_trace(name, data_folder)[1]
+
+
+def subject_info_from_data(df: pd.DataFrame) -> dict:
+    """
+    Compute the subject information from the data of a trace.
+    Args:
+        df: pd.DataFrame, data including the bolus_cf, bolus_bg_target, bolus_cr and basal columns
     Returns:
         dict: subject information including cf, gt, cr, bw, and u2ss
     """
-    data_path = os.path.join("data", f"Tidepool_{name}.csv")
-    df = pd.read_csv(data_path)
-    
     cf_mean = df.bolus_cf.dropna().mean()
     cf = 40 if np.isnan(cf_mean) else cf_mean
 
@@ -54,65 +118,139 @@ def load_subject_info(name: str) -> dict:
     return {'cf': cf, 'gt': gt, 'cr': cr, 'bw': bw, 'u2ss': u2ss}
 
 
-def retrieve_t_pers(save_name: str, subject_info: dict, save_folder: str, twinning_method: str) -> float:
+def load_twin_draws(save_name: str, save_folder: str, twinning_method: str, n_samples: int = 1) -> dict:
     """
-    Retrieve personalized parameter t_pers for drCORRECT algorithm from saved digital twin.
+    Load the model parameters of a saved digital twin.
     Args:
         save_name: str, name of the twin
-        subject_info: dict, subject information
         save_folder: str, folder where results are saved
         twinning_method: str, method used for twinning ('map' or 'mcmc')
+        n_samples: int, number of posterior draws to load for MCMC twins (1, 10, 100 or 1000)
     Returns:
-        t_pers: float, personalized parameter
+        model_parameters: dict, parameter name -> float (map twins or n_samples=1) or np.ndarray of posterior draws
     """
     if twinning_method == "map":
         data = pd.read_pickle(os.path.join(save_folder, "results", twinning_method, f"{twinning_method}_{save_name}.pkl"))
-        model_parameters = data["draws"].copy()
-    else:  # MCMC
-        with open(os.path.join(save_folder, "results", twinning_method, f"{twinning_method}_{save_name}.pkl"), 'rb') as f:
-            data_mcmc = pickle.load(f)
-        data_mcmc = data_mcmc['draws']
-        model_parameters = {
+        return data["draws"].copy()
+    
+    # MCMC
+    with open(os.path.join(save_folder, "results", twinning_method, f"{twinning_method}_{save_name}.pkl"), 'rb') as f:
+        data_mcmc = pickle.load(f)
+    data_mcmc = data_mcmc['draws']
+    if n_samples == 1:
+        return {
             outer_key: float(inner_dict['samples_1'][0]) 
             for outer_key, inner_dict in data_mcmc.items()
         }
-        
-    ka2 = model_parameters['ka2']
-    ke  = 0.127
-    kd  = model_parameters['kd']
-    u2ss = subject_info['u2ss']  # basal steady-state input
-    
-    mP = {"ka2": ka2,
-          "ke": ke,
-          "kd": kd,
-          "u2ss": u2ss}
-    
-    T_total = 1000
-    x_mat = np.zeros((T_total, 3))
-    insulin_input_delayed = np.ones(T_total) * u2ss
-    insulin_input_delayed[:5] = u2ss + 1  # small bolus at the beginning
-    
-    x_mat[0,:] = np.array([u2ss/kd, u2ss/ka2, u2ss/ke])  # initial conditions: steady-state
-    
-    for k in range(1,T_total):
-        x_mat[k,:] = replaybg_backward_euler_matlab_implementation(
-                                            x_mat[k-1,:],
-                                            insulin_input_delayed[k-1],
-                                            mP)
-        
-    Ip = x_mat[:,2]
-    t = np.arange(T_total)
+    return {
+        outer_key: np.asarray(inner_dict[f'samples_{n_samples}'], dtype=float)
+        for outer_key, inner_dict in data_mcmc.items()
+    }
+
+
+def retrieve_t_pers(save_name: str, subject_info: dict, save_folder: str, twinning_method: str, statistic: str = 'first') -> float:
+    """
+    Retrieve personalized parameter t_pers for drCORRECT algorithm from saved digital twin.
+    Args:
+        save_name: str, name of the twin
+        subject_info: dict, subject information
+        save_folder: str, folder where results are saved
+        twinning_method: str, method used for twinning ('map' or 'mcmc')
+        statistic: str, 'first' to use the first posterior draw of MCMC twins, 'median' to use the median of 
+            the t_pers posterior distribution (see retrieve_t_pers_distribution)
+    Returns:
+        t_pers: float, personalized parameter
+    """
+    if statistic == 'median':
+        return retrieve_t_pers_distribution(save_name, subject_info, save_folder, twinning_method)['median']
+    if statistic != 'first':
+        raise ValueError(f"Unknown statistic '{statistic}', use 'first' or 'median'.")
     
-    tmax = t[np.argmax(Ip)]
+    model_parameters = load_twin_draws(save_name, save_folder, twinning_method)
     
-    # plt.plot(t, Ip)
-    # plt.xlabel("Time")
-    # plt.ylabel("Compartment 3")
-    # plt.axvline(tmax, color='r', linestyle='--', label=f'Tmax: {tmax:.2f} min')
-    # plt.legend()
-    # plt.show()
+    return compute_t_pers(model_parameters['ka2'], model_parameters['kd'], subject_info['u2ss'])
+
+
+def retrieve_t_pers_distribution(save_name: str, subject_info: dict, save_folder: str, twinning_method: str,
+                                 n_samples: int = 1000, ci: float = 0.95) -> dict:
+    """
+    Retrieve the posterior distribution of t_pers from all the draws of a saved digital twin (a single draw for map twins).
+    Args:
+        save_name: str, name of the twin
+        subject_info: dict, subject information
+        save_folder: str, folder where results are saved
+        twinning_method: str, method used for twinning ('map' or 'mcmc')
+        n_samples: int, number of posterior draws to use for MCMC twins (1, 10, 100 or 1000)
+        ci: float, probability mass of the credible interval
+    Returns:
+        distribution: dict, with keys 't_pers' (np.ndarray, one value per draw), 'median', 'mean', 
+            'ci_low' and 'ci_high' (bounds of the equal-tailed credible interval)
+    """
+    model_parameters = load_twin_draws(save_name, save_folder, twinning_method, n_samples)
+    t_pers = np.atleast_1d(compute_t_pers(model_parameters['ka2'], model_parameters['kd'], subject_info['u2ss']))
+    ci_low, ci_high = np.quantile(t_pers, [(1 - ci) / 2, (1 + ci) / 2])
     
-    return tmax*1.5 if tmax*1.5 > 60 else 60
+    return {'t_pers': t_pers,
+            'median': float(np.median(t_pers)),
+            'mean': float(np.mean(t_pers)),
+            'ci_low': float(ci_low),
+            'ci_high': float(ci_high)}
+
+
+def compute_t_pers(ka2: float | np.ndarray, kd: float | np.ndarray, u2ss: float) -> float | np.ndarray:
+    """
+    Compute t_pers from the insulin kinetics parameters: 1.5 times the time of the plasma insulin peak
+    after a small bolus, and at least 60 min.
+    Args:
+        ka2: float or np.ndarray, insulin absorption rate (one value per posterior draw if an array)
+        kd: float or np.ndarray, insulin dissociation rate (same shape as ka2)
+        u2ss: float, basal steady-state input
+    Returns:
+        t_pers: float or np.ndarray, personalized parameter (same shape as ka2)
+    """
+    tmax = insulin_peak_time(ka2, kd, u2ss)
+    t_pers = np.where(tmax*1.5 > 60, tmax*1.5, 60)
+    
+    return float(t_pers) if t_pers.ndim == 0 else t_pers
+
+
+def insulin_peak_time(ka2: float | np.ndarray, kd: float | np.ndarray, u2ss: float, ke: float = 0.127, T_total: int = 1000) -> np.ndarray:
+    """
+    Time (min) of the peak of plasma insulin (Ip) of the 3-compartment insulin model, starting from steady state
+    with a 1 mU/kg/min bolus over the first 5 min. The model is integrated with the same backward Euler steps as
+    replaybg_backward_euler_matlab_implementation, vectorized over the parameter draws and keeping only the
+    running maximum, so the result is identical to the argmax of the full Ip trajectory.
+    Args:
+        ka2: float or np.ndarray, insulin absorption rate
+        kd: float or np.ndarray, insulin dissociation rate
+        u2ss: float, basal steady-state input
+        ke: float, insulin clearance rate
+        T_total: int, simulation length (min)
+    Returns:
+        tmax: np.ndarray, peak time (same shape as ka2)
+    """
+    ka2 = np.asarray(ka2, dtype=float)
+    kd = np.asarray(kd, dtype=float)
+    
+    # initial conditions: steady-state
+    isc1 = u2ss/kd
+    isc2 = u2ss/ka2
+    ip = np.full(np.broadcast(ka2, kd).shape, u2ss/ke)
+    
+    ip_max = ip.copy()
+    tmax = np.zeros(ip.shape, dtype=int)
+    for k in range(1, T_total):
+        ins = u2ss + 1 if k - 1 < 5 else u2ss  # small bolus at the beginning
+        isc1 = (isc1 + ins)/(1+kd)
+        isc2 = (isc2 + kd*isc1)/(1+ka2)
+        ip = (ip + ka2*isc2)/(1+ke)
+        
+        # strict comparison keeps the first maximum, as np.argmax
+        higher = ip > ip_max
+        ip_max = np.where(higher, ip, ip_max)
+        tmax = np.where(higher, k, tmax)
+    
+    return tmax
 
 
 def replaybg_backward_euler_matlab_implementation(xkm1: np.ndarray, INS: float, mP: dict) -> np.ndarray:
@@ -141,36 +279,189 @@ def replaybg_backward_euler_matlab_implementation(xkm1: np.ndarray, INS: float,
     return xk
 
 
-def save_comparison(results: dict, save_folder: str, trace_name: str, twinning_method: str) -> pd.DataFrame:
+# Metrics saved by save_comparison, in order
+METRICS = ['TIR (%)', 'TAR (%)', 'TBR (%)', 'GRI (-)', 'Mean Glucose (mg/dl)', 'CV of Glucose (%)', 'STD of Glucose (mg/dl)', 'STD of Glucose ROC (mg/dl/min)']
+
+# Entries kept by each metrics cache (least recently used first out): each entry holds a reference to its glucose array
+METRICS_CACHE_SIZE = 16
+
+# Metrics of the replay results already evaluated, keyed by (trace, strategy)
+_metrics_cache = OrderedDict()
+
+# Metrics of the glucose realizations of the replay results already evaluated, keyed by (trace, strategy, ci)
+_realization_metrics_cache = OrderedDict()
+
+
+def glucose_metrics(glucose: np.ndarray) -> dict:
+    """
+    Compute all the glycemic control metrics of glucose profiles sampled every minute in one pass.
+    Equivalent to the py_agata metrics (time_in_target, time_in_hyperglycemia, time_in_hypoglycemia, gri,
+    mean_glucose, median_glucose, cv_glucose, std_glucose, std_glucose_roc) but without building a DataFrame
+    and sharing the intermediate quantities.
+    Args:
+        glucose: np.ndarray, glucose profile (mg/dl), or matrix with one profile per row
+    Returns:
+        metrics: dict, metric name -> float (np.ndarray with one value per row for a matrix), with the keys 
+            in METRICS plus 'Median Glucose (mg/dl)'
+    """
+    glucose = np.asarray(glucose, dtype=float)
+    n = np.sum(~np.isnan(glucose), axis=-1)
+    
+    # time in ranges (comparisons with nan are False, so nan samples are never counted)
+    def time_in(flags):
+        return 100 * np.sum(flags, axis=-1) / n
+    
+    tar = time_in(glucose >= 180)
+    tbr = time_in(glucose <= 70)
+    tir = time_in((glucose > 70) & (glucose < 180))
+    
+    # glycemia risk index
+    v_low = time_in(glucose <= 54)
+    low = time_in((glucose > 54) & (glucose <= 70))
+    v_high = time_in(glucose >= 250)
+    high = time_in((glucose >= 180) & (glucose < 250))
+    gri = np.minimum((3.0 * v_low) + (2.4 * low) + (1.6 * v_high) + (0.8 * high), 100)
+    
+    # variability
+    mean = np.nanmean(glucose, axis=-1)
+    std = np.nanstd(glucose, axis=-1, ddof=1)
+    
+    # rate of change over 3 samples (15 min on the py_agata 5-min grid)
+    roc = np.full(glucose.shape, np.nan)
+    if glucose.shape[-1] > 4:
+        roc[..., 3:] = (glucose[..., 3:] - glucose[..., :-3]) / 15
+    
+    metrics = {
+        'TIR (%)': tir,
+        'TAR (%)': tar,
+        'TBR (%)': tbr,
+        'GRI (-)': gri,
+        'Mean Glucose (mg/dl)': mean,
+        'CV of Glucose (%)': 100 * std / mean,
+        'STD of Glucose (mg/dl)': std,
+        'STD of Glucose ROC (mg/dl/min)': np.nanstd(roc, axis=-1, ddof=1),
+        'Median Glucose (mg/dl)': np.nanmedian(glucose, axis=-1),
+    }
+    
+    if glucose.ndim == 1:
+        return {metric: float(value) for metric, value in metrics.items()}
+    return metrics
+
+
+def compute_metrics(result: dict, key: tuple | None = None) -> dict:
+    """
+    Compute the glycemic control metrics of a replay result.
+    Args:
+        result: dict, ReplayBG replay results
+        key: tuple, (trace, strategy) key to cache the metrics under (None to not cache them)
+    Returns:
+        metrics: dict, metric name -> value (of the median glucose profile), see glucose_metrics
+    """
+    glucose = result['glucose']['median']
+    
+    metrics = _cached_metrics(_metrics_cache, key, glucose)
+    if metrics is not None:
+        return metrics
+    
+    metrics = glucose_metrics(glucose)
+    _cache_metrics(_metrics_cache, key, glucose, metrics)
+    
+    return metrics
+
+
+def realization_metrics(result: dict, key: tuple | None = None, ci: float = 0.95) -> dict:
     """
-    Save comparison results to CSV file.
+    Compute the glycemic control metrics of all the glucose realizations of a replay result at once (one row
+    of the realization matrix per posterior draw) and summarize each metric over the realizations.
     Args:
-        results: dict, replay results from different strategies
+        result: dict, ReplayBG replay results (the median glucose profile is used if the realizations are missing)
+        key: tuple, (trace, strategy) key to cache the metrics under (None to not cache them)
+        ci: float, probability mass of the confidence band
+    Returns:
+        metrics: dict, with keys 'n_realizations', 'realizations' (metric name -> np.ndarray, one value per
+            realization), 'median', 'ci_low' and 'ci_high' (metric name -> float, see glucose_metrics for the names)
+    """
+    glucose = result['glucose'].get('realizations', result['glucose']['median'])
+    
+    key = None if key is None else (*key, ci)
+    metrics = _cached_metrics(_realization_metrics_cache, key, glucose)
+    if metrics is not None:
+        return metrics
+    
+    values = glucose_metrics(np.atleast_2d(glucose))
+    names = list(values)
+    ci_low, median, ci_high = np.nanquantile(np.column_stack([values[name] for name in names]), [(1 - ci) / 2, 0.5, (1 + ci) / 2], axis=0)
+    
+    metrics = {'n_realizations': len(values[names[0]]),
+               'realizations': values,
+               'median': dict(zip(names, median.tolist())),
+               'ci_low': dict(zip(names, ci_low.tolist())),
+               'ci_high': dict(zip(names, ci_high.tolist()))}
+    _cache_metrics(_realization_metrics_cache, key, glucose, metrics)
+    
+    return metrics
+
+
+def _cached_metrics(cache: OrderedDict, key: tuple | None, glucose: np.ndarray) -> dict | None:
+    """
+    Metrics cached under key for the same glucose array (None if missing), marking them as recently used.
+    """
+    if key is None or key not in cache or cache[key][0] is not glucose:
+        return None
+    cache.move_to_end(key)
+    return cache[key][1]
+
+
+def _cache_metrics(cache: OrderedDict, key: tuple | None, glucose: np.ndarray, metrics: dict) -> None:
+    """
+    Cache metrics under key (nothing if key is None), dropping the least recently used entries beyond METRICS_CACHE_SIZE.
+    """
+    if key is None:
+        return
+    cache[key] = (glucose, metrics)
+    cache.move_to_end(key)
+    while len(cache) > METRICS_CACHE_SIZE:
+        cache.popitem(last=False)
+
+
+def clear_metrics_cache() -> None:
+    """
+    Drop the cached metrics.
+    """
+    _metrics_cache.clear()
+    _realization_metrics_cache.clear()
+
+
+def save_comparison(results: dict, save_folder: str, trace_name: str, twinning_method: str, store_folder: str | None = None,
+                    ci: float = 0.95) -> pd.DataFrame:
+    """
+    Save comparison results to CSV file and, optionally, to the cohort results store (see src.store).
+    Each metric is computed on every glucose realization of a strategy and summarized by its median; the medians
+    and confidence bands are also saved to comparison_bands_<trace>_<method>.csv, one row per strategy and metric.
+    Args:
+        results: dict, replay results from different strategies (one column per strategy)
         save_folder: str, folder to save the results
         trace_name: str, name of the trace
+        twinning_method: str, method used for twinning ('map' or 'mcmc')
+        store_folder: str, root folder of the cohort results store (None to not append the results)
+        ci: float, probability mass of the confidence bands
     Returns:
-        df: pd.DataFrame, comparison results
+        df: pd.DataFrame, comparison results (median of each metric over the realizations)
     """
-    df = pd.DataFrame(columns=['Original data', 'Aleppo guidelines', 'drCORRECT algorithm'], 
-                      index=['TIR (%)', 'TAR (%)', 'TBR (%)', 'GRI (-)', 'Mean Glucose (mg/dl)', 'CV of Glucose (%)', 'STD of Glucose (mg/dl)', 'STD of Glucose ROC (mg/dl/min)'])
+    df = pd.DataFrame(columns=list(results), index=METRICS)
     
+    bands = []
     for key, result in results.items():
-        tt = pd.date_range(start=result['rbg_data'].t_data.min(), end=result['rbg_data'].t_data.max()+pd.Timedelta("4min"),freq="1min")
-        df_res = pd.DataFrame(pd.DataFrame({
-                            't': tt,
-                            'glucose': result['glucose']['median']
-                        }))
-        
-        df.at['TIR (%)', key] = time_in_target(df_res)
-        df.at['TAR (%)', key] = time_in_hyperglycemia(df_res)
-        df.at['TBR (%)', key] = time_in_hypoglycemia(df_res)
-        df.at['GRI (-)', key] = gri(df_res)
-        df.at['Mean Glucose (mg/dl)', key] = mean_glucose(df_res)
-        df.at['CV of Glucose (%)', key] = cv_glucose(df_res)
-        df.at['STD of Glucose (mg/dl)', key] = std_glucose(df_res)
-        df.at['STD of Glucose ROC (mg/dl/min)', key] = std_glucose_roc(df_res)
+        metrics = realization_metrics(result, (trace_name, key), ci)
+        for metric in METRICS:
+            df.at[metric, key] = metrics['median'][metric]
+            bands.append({'strategy': key, 'metric': metric, 'n_realizations': metrics['n_realizations'],
+                          'median': metrics['median'][metric], 'ci_low': metrics['ci_low'][metric], 'ci_high': metrics['ci_high'][metric]})
     
     os.makedirs(save_folder, exist_ok=True)
     df.to_csv(os.path.join(save_folder, f"comparison_results_{trace_name}_{twinning_method}.csv"))
+    pd.DataFrame(bands).to_csv(os.path.join(save_folder, f"comparison_bands_{trace_name}_{twinning_method}.csv"), index=False)
+    if store_folder is not None:
+        append_results(df, store_folder, trace_name, twinning_method)
     
     return df
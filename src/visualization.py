@@ -3,81 +3,214 @@ Visualization utilities for original, twinned, and comparative glucose-insulin d
 """
 
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import numpy as np
 import pandas as pd
 import os
 
-def plot_original_data(data: pd.DataFrame, output_folder: str, trace_name: str) -> tuple[plt.Figure, plt.Axes]:
-    fig, axs = plt.subplots(3, 1, figsize=(12, 8), sharex=True,
-                gridspec_kw={'height_ratios': [3, 1, 1]})
+from src.strategies import STRATEGIES
+from src.workspace import save_replay, workspace_path
+from src.cache import ReplayCache
+
+
+class FigureTemplate:
+    """
+    Figure whose layout (axes, labels, grids, limits and reference lines) is built once and reused across traces:
+    drawing a new trace only replaces the data artists. Headless templates are not managed by pyplot and are
+    rendered with the Agg backend, so they can be used in worker processes without a display.
+    """
+
+    def __init__(self, fig: Figure, axs: np.ndarray, twins: list):
+        self.fig = fig
+        self.axs = axs
+        self.twins = twins
+        self._artists = []
+        self._laid_out = False
+
+    def add(self, artist: object) -> object:
+        """
+        Register a data artist, removed at the next clear.
+        """
+        self._artists.append(artist)
+        return artist
+
+    def clear(self) -> None:
+        """
+        Remove the data artists.
+        """
+        for artist in self._artists:
+            artist.remove()
+        self._artists = []
+
+    def autoscale(self) -> None:
+        """
+        Recompute the data limits of the axes (needed after clear).
+        """
+        for ax in list(self.axs) + self.twins:
+            ax.relim()
+            ax.autoscale_view()
+
+    def save(self, path: str) -> str:
+        """
+        Save the figure (the layout is tightened only the first time).
+        """
+        if not self._laid_out:
+            self.fig.tight_layout()
+            self._laid_out = True
+        self.fig.savefig(path)
+        return path
+
+
+def _new_figure(figsize: tuple, headless: bool) -> Figure:
+    if headless:
+        fig = Figure(figsize=figsize)
+        FigureCanvasAgg(fig)
+        return fig
+    return plt.figure(figsize=figsize)
+
+
+def _nonzero(values: np.ndarray) -> np.ndarray:
+    # samples drawn as bars (zero-height bars are invisible, skipping them avoids one patch per sample)
+    return np.flatnonzero(values)
+
+
+def nearest_cho_labels(data: pd.DataFrame) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Label of each meal, taken from the nearest (by index, the earliest on ties) sample with a cho_label.
+    Args:
+        data: pd.DataFrame, original data sorted by index
+    Returns:
+        meals: np.ndarray, positions of the samples with cho > 0
+        labels: np.ndarray, their labels (empty if no sample is labeled)
+    """
+    index = data.index.to_numpy()
+    meals = np.flatnonzero(data['cho'].to_numpy() > 0)
+    labeled = data['cho_label'].notna().to_numpy()
+    label_index, labels = index[labeled], data['cho_label'].to_numpy()[labeled]
+    if labels.size == 0:
+        return meals[:0], labels
+
+    x = index[meals]
+    pos = np.searchsorted(label_index, x)
+    left = np.clip(pos - 1, 0, labels.size - 1)
+    right = np.clip(pos, 0, labels.size - 1)
+    nearest = np.where(np.abs(x - label_index[left]) <= np.abs(label_index[right] - x), left, right)
+    return meals, labels[nearest]
+
+
+def original_data_template(headless: bool = True) -> FigureTemplate:
+    """
+    Build the layout of the original data figure (CGM, CHO, bolus and basal insulin).
+    Args:
+        headless: bool, whether the figure is rendered with Agg outside pyplot
+    Returns:
+        template: FigureTemplate, figure to draw with draw_original_data
+    """
+    fig = _new_figure((12, 8), headless)
+    axs = fig.subplots(3, 1, sharex=True, gridspec_kw={'height_ratios': [3, 1, 1]})
 
-    ##### CGM #####
-    axs[0].plot(data.t, data['glucose'], label='CGM', color='black', linestyle='-', marker='.', markersize=5)
     axs[0].set_ylabel('Glucose [mg/dL]')
     axs[0].set_title(f'Example original data')
-    axs[0].legend(loc='upper right')
     axs[0].grid(True)
     axs[0].axhline(y=180, color='gold', alpha=0.5, linestyle='--')
     axs[0].axhline(y=70, color='darkred', alpha=0.5, linestyle='--')
-    
-    ##### CHO #####
-    axs[1].bar(data.t, data['cho'].fillna(0), color='deepskyblue', width=0.01, label='CHO')
+
     axs[1].set_ylabel('CHO [g]')
-    axs[1].legend(loc='upper right')
     axs[1].grid(True)
-    
+
+    axs[2].set_ylabel('Bolus [U]')
+    axs[2].grid(True)
+    axs[2].set_xlabel('Time')
+
+    ax2 = axs[2].twinx()
+    ax2.set_ylabel('Basal [U]')
+    ax2.tick_params(axis='y')
+
+    return FigureTemplate(fig, axs, [ax2])
+
+
+def draw_original_data(template: FigureTemplate, data: pd.DataFrame) -> None:
+    """
+    Draw the original data of a trace in a template built by original_data_template.
+    """
+    template.clear()
+    axs, (ax2,) = template.axs, template.twins
+    t = data['t'].to_numpy()
+
+    ##### CGM #####
+    template.add(axs[0].plot(t, data['glucose'], label='CGM', color='black', linestyle='-', marker='.', markersize=5)[0])
+    axs[0].legend(loc='upper right')
+
+    ##### CHO #####
+    cho = data['cho'].fillna(0).to_numpy()
+    bars = _nonzero(cho)
+    template.add(axs[1].bar(t[bars], cho[bars], color='deepskyblue', width=0.01, label='CHO'))
+    axs[1].legend(loc='upper right')
+
     # Annotate cho_label
-    labeled = data[data['cho_label'].notna()][['cho_label','t']].copy()
-    labeled['ts'] = labeled.index
-
-    for idx, row in data.iterrows():
-        if row['cho'] > 0:
-            # Find the nearest labeled point in time
-            time_diff = abs(labeled['ts'] - idx)
-            nearest_idx = time_diff.idxmin()
-            label = labeled.loc[nearest_idx, 'cho_label']
-            axs[1].text(data.t[idx], row['cho'] + 1, label, ha='center', va='bottom', fontsize=10, color='black')
+    meals, labels = nearest_cho_labels(data)
+    for i, label in zip(meals, labels):
+        template.add(axs[1].text(t[i], cho[i] + 1, label, ha='center', va='bottom', fontsize=10, color='black'))
     axs[1].set_ylim(0, data['cho'].max() + 3)
 
     ##### Insulin #####
     # Bolus insulin
-    axs[2].bar(data.t, data['bolus'].fillna(0), color='limegreen', width=0.01)
-    axs[2].set_ylabel('Bolus [U]')
-    axs[2].legend(['Bolus'], loc='upper left')
-    axs[2].grid(True)
+    bolus = data['bolus'].fillna(0).to_numpy()
+    bars = _nonzero(bolus)
+    bolus_bars = template.add(axs[2].bar(t[bars], bolus[bars], color='limegreen', width=0.01))
+    axs[2].legend([bolus_bars], ['Bolus'], loc='upper left')
     axs[2].set_ylim(0, data['bolus'].max() + 3)
-    
+
     # Basal insulin
-    ax2 = axs[2].twinx()
-    ax2.plot(data.t, data['basal'], color='lime', linestyle='--', label='Basal Insulin')
-    ax2.set_ylabel('Basal [U]')
-    ax2.tick_params(axis='y')
-    ax2.legend(['Basal Insulin'], loc='upper right')
+    basal_line = template.add(ax2.plot(t, data['basal'], color='lime', linestyle='--', label='Basal Insulin')[0])
+    ax2.legend([basal_line], ['Basal Insulin'], loc='upper right')
+
+    template.autoscale()
 
-    # Final plot adjustments and saving
-    plt.xlabel('Time')
-    plt.tight_layout()
+
+def plot_original_data(data: pd.DataFrame, output_folder: str, trace_name: str,
+                       template: FigureTemplate | None = None) -> tuple[plt.Figure, plt.Axes]:
+    """
+    Plot the original data of a trace and save it as original_data_plot_<trace_name>.png.
+    Args:
+        data: pd.DataFrame, original data
+        output_folder: str, folder of the figure
+        trace_name: str, name of the trace
+        template: FigureTemplate, reused figure (see original_data_template), None for a new pyplot figure
+    Returns:
+        fig, axs: figure and its CGM, CHO and bolus axes
+    """
+    if template is None:
+        template = original_data_template(headless=False)
+    draw_original_data(template, data)
 
     save_name = f"original_data_plot_{trace_name}"
-    plt.savefig(os.path.join(output_folder, f"{save_name}.png"))
+    template.save(os.path.join(output_folder, f"{save_name}.png"))
     
-    return fig, axs
+    return template.fig, template.axs
 
 
-def plot_twinned_data(rbg: object, twinning_method: str, original_data: pd.DataFrame, subject_info: dict, save_name: str, output_folder: str, trace_name: str) -> None:
+def plot_twinned_data(rbg: object, twinning_method: str, original_data: pd.DataFrame, subject_info: dict, save_name: str, output_folder: str, trace_name: str,
+                      cache: ReplayCache | None = None, n_replay: int = 1) -> None:
 
     fig, axs = plot_original_data(original_data, output_folder, trace_name)
 
     # do some other plot in the same figure
-    replay_results = rbg.replay(data=original_data, bw=subject_info['bw'], save_name=save_name,
-                                n_replay=1,
-                                twinning_method=twinning_method,
-                                save_workspace=True,
-                                save_suffix=f'_replay_twin_{twinning_method}')
+    replay_kwargs = dict(data=original_data, bw=subject_info['bw'], save_name=save_name,
+                         n_replay=n_replay,
+                         twinning_method=twinning_method,
+                         save_workspace=False)
+    replay_results = rbg.replay(**replay_kwargs) if cache is None else cache.replay(rbg, **replay_kwargs)
+    save_replay(replay_results, workspace_path(rbg, save_name, f'_replay_twin_{twinning_method}'))
     
     twinned_glucose = replay_results['glucose']['median']
 
     tt = pd.date_range(start=original_data['t'].min(), end=original_data['t'].max()+pd.Timedelta("4min"),freq="1min")
     axs[0].plot(tt, twinned_glucose, color='red', linestyle='-', marker='o', markersize=2, mfc='none', label='Digital twin')
+    if n_replay > 1:
+        ci_low, ci_high = np.percentile(replay_results['glucose']['realizations'], [5, 95], axis=0)
+        axs[0].fill_between(tt, ci_low, ci_high, color='red', alpha=0.2, linewidth=0, label=f'Digital twin (90% band, {n_replay} realizations)')
 
     axs[0].legend()
     
@@ -86,84 +219,116 @@ def plot_twinned_data(rbg: object, twinning_method: str, original_data: pd.DataF
     plt.close('all')
     
 
-def plot_comparison(results: dict, output_folder: str, trace_name: str, twinning_method: str) -> None:
-    
-    fig, axs = plt.subplots(4, 1, figsize=(14, 10), sharex=True,
-                gridspec_kw={'height_ratios': [5, 1, 1, 1]})
+def comparison_template(names: list[str], headless: bool = True) -> FigureTemplate:
+    """
+    Build the layout of the strategy comparison figure: glucose and CHO, then one insulin panel per strategy.
+    Args:
+        names: list, names of the compared strategies, in the order of the results
+        headless: bool, whether the figure is rendered with Agg outside pyplot
+    Returns:
+        template: FigureTemplate, figure to draw with draw_comparison
+    """
+    fig = _new_figure((14, 5.5 + 1.5 * len(names)), headless)
+    axs = fig.subplots(1 + len(names), 1, sharex=True, gridspec_kw={'height_ratios': [5] + [1] * len(names)})
 
-    tt = pd.date_range(start=results['Original data']['rbg_data'].t_data.min(), end=results['Original data']['rbg_data'].t_data.max()+pd.Timedelta("4min"),freq="1min")
-    
     ##### CGM #####
-    axs[0].plot(tt, results['Original data']['glucose']['median'], label='Baseline', color='black', linestyle='--', markersize=1)
-    axs[0].plot(tt, results['Aleppo guidelines']['glucose']['median'], label='Aleppo guidelines', color='red', linestyle='-', marker='o', markersize=1)
-    axs[0].plot(tt, results['drCORRECT algorithm']['glucose']['median'], label='drCORRECT algorithm', color='green', linestyle='-', marker='o', markersize=1)
     axs[0].axhline(y=180, color='gold', alpha=0.5, linestyle='--')
     axs[0].axhline(y=70, color='darkred', alpha=0.5, linestyle='--')
-    
     axs[0].set_ylabel('Glucose [mg/dL]')
-    axs[0].legend(loc='upper left')
     axs[0].grid(True)
     axs[0].set_ylim([39, 350])
-    
+
     ##### CHO ##### (with CGM)
     ax0 = axs[0].twinx()
-    ax0.bar(tt, results['Original data']['cho']['realizations'][0, :], color='deepskyblue', width=0.005, label='CHO')
     ax0.set_ylabel('CHO [g]')
-    ax0.legend(loc='upper right')
     ax0.set_ylim([0, 120])
-    
+
     ##### Insulin #####
-    # Original data
-    axs[1].bar(tt, results['Original data']['insulin_bolus']['realizations'][0, :], color='black', label='Original bolus', width=0.008)
-    axs[1].set_ylabel('Bolus [U]')
-    axs[1].legend(loc='upper left')
-    axs[1].set_title('Original data insulin')
-    axs[1].grid(True)
-    axs[1].set_ylim(0, 5)
-    
-    ax1 = axs[1].twinx()
-    ax1.plot(tt, results['Original data']['insulin_basal']['realizations'][0, :], color='black', linestyle='--', linewidth=0.8)
-    ax1.set_ylabel('Basal [U]')
-    ax1.tick_params(axis='y')
-    ax1.legend(['Original basal insulin'], loc='upper right')
-    ax1.set_ylim([0, 0.1])
-    
-    # Aleppo guidelines
-    axs[2].bar(tt, results['Aleppo guidelines']['insulin_bolus']['realizations'][0, :], color='black', label='Bolus from data', width=0.008)
-    axs[2].bar(tt, results['Aleppo guidelines']['correction_bolus']['realizations'][0, :], color='red', label='CIB', width=0.008)
-    axs[2].set_ylabel('Bolus [U]')
-    axs[2].set_title('Aleppo guidelines insulin')
-    axs[2].legend(loc='upper left')
-    axs[2].grid(True)
-    axs[2].set_ylim(0, 5)
+    twins = [ax0]
+    for ax, name in zip(axs[1:], names):
+        ax.set_ylabel('Bolus [U]')
+        ax.set_title(f'{name} insulin')
+        ax.grid(True)
+        ax.set_ylim(0, 5)
+
+        ax_basal = ax.twinx()
+        ax_basal.set_ylabel('Basal [U]')
+        ax_basal.tick_params(axis='y')
+        ax_basal.set_ylim([0, 0.1])
+        twins.append(ax_basal)
+    axs[-1].set_xlabel('Time')
+
+    return FigureTemplate(fig, axs, twins)
+
+
+def draw_comparison(template: FigureTemplate, results: dict) -> None:
+    """
+    Draw the replay results of the compared strategies in a template built by comparison_template
+    (with the same strategies, in the same order).
+    """
+    template.clear()
     
-    ax2 = axs[2].twinx()
-    ax2.plot(tt, results['Original data']['insulin_basal']['realizations'][0, :], color='black', linestyle='--', linewidth=0.8)
-    ax2.set_ylabel('Basal [U]')
-    ax2.tick_params(axis='y')
-    ax2.legend(['Original basal insulin'], loc='upper right')
-    ax2.set_ylim([0, 0.1])
+    # the first strategy is the reference for CHO and basal insulin
+    names = list(results)
+    reference = results[names[0]]
+    axs, (ax0, *basal_axs) = template.axs, template.twins
+
+    tt = pd.date_range(start=reference['rbg_data'].t_data.min(), end=reference['rbg_data'].t_data.max()+pd.Timedelta("4min"),freq="1min")
     
-    # drCORRECT algorithm
-    axs[3].bar(tt, results['drCORRECT algorithm']['insulin_bolus']['realizations'][0, :], color='black', label='Bolus from data', width=0.008)
-    axs[3].bar(tt, results['drCORRECT algorithm']['correction_bolus']['realizations'][0, :], color='green', label='CIB', width=0.008)
-    axs[3].set_ylabel('Bolus [U]')
-    axs[3].legend(loc='upper left')
-    axs[3].grid(True)
-    axs[3].set_ylim(0, 5)
+    ##### CGM #####
+    for name in names:
+        entry = STRATEGIES.get(name, {'handler': True, 'plot_label': name, 'color': None})
+        if entry['handler'] is None:
+            line, = axs[0].plot(tt, results[name]['glucose']['median'], label=entry['plot_label'], color=entry['color'], linestyle='--', markersize=1)
+        else:
+            line, = axs[0].plot(tt, results[name]['glucose']['median'], label=entry['plot_label'], color=entry['color'], linestyle='-', marker='o', markersize=1)
+        template.add(line)
+    axs[0].legend(loc='upper left')
     
-    ax3 = axs[3].twinx()
-    ax3.plot(tt, results['Original data']['insulin_basal']['realizations'][0, :], color='black', linestyle='--', linewidth=0.8)
-    ax3.set_ylabel('Basal [U]')
-    axs[3].set_title('drCORRECT algorithm insulin')
-    ax3.tick_params(axis='y')
-    ax3.legend(['Original basal insulin'], loc='upper right')
-    ax3.set_ylim([0, 0.1])
+    ##### CHO ##### (with CGM)
+    cho = reference['cho']['realizations'][0, :]
+    bars = _nonzero(cho)
+    template.add(ax0.bar(tt[bars], cho[bars], color='deepskyblue', width=0.005, label='CHO'))
+    ax0.legend(loc='upper right')
     
-    # Final plot adjustments and saving
-    plt.xlabel('Time')
-    plt.tight_layout()
+    ##### Insulin #####
+    basal = reference['insulin_basal']['realizations'][0, :]
+    for ax, ax_basal, name in zip(axs[1:], basal_axs, names):
+        entry = STRATEGIES.get(name, {'handler': True, 'color': None})
+        bolus = results[name]['insulin_bolus']['realizations'][0, :]
+        bars = _nonzero(bolus)
+        if entry['handler'] is None:
+            template.add(ax.bar(tt[bars], bolus[bars], color='black', label='Original bolus', width=0.008))
+        else:
+            template.add(ax.bar(tt[bars], bolus[bars], color='black', label='Bolus from data', width=0.008))
+            correction_bolus = results[name]['correction_bolus']['realizations'][0, :]
+            bars = _nonzero(correction_bolus)
+            template.add(ax.bar(tt[bars], correction_bolus[bars], color=entry['color'], label='CIB', width=0.008))
+        ax.legend(loc='upper left')
+        
+        basal_line = template.add(ax_basal.plot(tt, basal, color='black', linestyle='--', linewidth=0.8)[0])
+        ax_basal.legend([basal_line], ['Original basal insulin'], loc='upper right')
+
+    template.autoscale()
+
+
+def plot_comparison(results: dict, output_folder: str, trace_name: str, twinning_method: str,
+                    template: FigureTemplate | None = None) -> None:
+    """
+    Plot the replay results of the compared strategies and save them as cib_comparison_plot_<trace_name>_<twinning_method>.png.
+    Args:
+        results: dict, replay results keyed by strategy name (see compare_corrective_strategies)
+        output_folder: str, folder of the figure
+        trace_name: str, name of the trace
+        twinning_method: str, method used for twinning
+        template: FigureTemplate, reused figure (see comparison_template), None for a new pyplot figure
+    """
+    new_figure = template is None
+    if new_figure:
+        template = comparison_template(list(results), headless=False)
+    draw_comparison(template, results)
 
     save_name = f"cib_comparison_plot_{trace_name}_{twinning_method}"
-    plt.savefig(os.path.join(output_folder, f"{save_name}.png"))
-    plt.close()
\ No newline at end of file
+    template.save(os.path.join(output_folder, f"{save_name}.png"))
+    if new_figure:
+        plt.close(template.fig)
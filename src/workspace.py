@@ -0,0 +1,108 @@
+"""
+Compact storage of replay results, as a replacement of the pickled ReplayBG workspaces.
+"""
+
+import os
+from collections.abc import Mapping
+from types import SimpleNamespace
+
+import numpy as np
+
+
+# Replay results whose realizations are stored (besides the median glucose and the time grid)
+REPLAY_ARRAYS = ['cho', 'insulin_bolus', 'insulin_basal', 'correction_bolus']
+
+
+def workspace_path(rbg: object, save_name: str, save_suffix: str) -> str:
+    """
+    Path of the compact workspace of a replay, in the results/workspaces folder of the ReplayBG object.
+    """
+    return os.path.join(rbg.environment.replay_bg_path, "results", "workspaces", save_name + save_suffix + ".npz")
+
+
+def save_replay(replay_results: dict, path: str, dtype: type = np.float32) -> str:
+    """
+    Save the replay results used by the analysis (median glucose, realizations of the glucose and of REPLAY_ARRAYS
+    and time grid) as float32 arrays in a compressed npz file.
+    Args:
+        replay_results: dict, ReplayBG replay results
+        path: str, path of the npz file
+        dtype: type, type of the stored arrays
+    Returns:
+        path: str, path of the npz file
+    """
+    arrays = {'glucose_median': np.asarray(replay_results['glucose']['median'], dtype=dtype),
+              't_data': np.asarray(replay_results['rbg_data'].t_data).astype('datetime64[ns]')}
+    if 'realizations' in replay_results['glucose']:
+        arrays['glucose_realizations'] = np.asarray(replay_results['glucose']['realizations'], dtype=dtype)
+    for key in REPLAY_ARRAYS:
+        arrays[key + '_realizations'] = np.asarray(replay_results[key]['realizations'], dtype=dtype)
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    np.savez_compressed(path, **arrays)
+    return path
+
+
+class ReplayWorkspace(Mapping):
+    """
+    Replay results loaded from a compact workspace, with the same layout as the ReplayBG replay results
+    (e.g., workspace['glucose']['median'], workspace['cho']['realizations'], workspace['rbg_data'].t_data).
+    Each array is read from the file only when it is first accessed, so the file stays open until close() is called
+    (use the workspace as a context manager, and load() the arrays needed after closing it). Workspaces saved
+    without the glucose realizations only have workspace['glucose']['median'].
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._npz = np.load(path)
+        self._cache = {}
+
+    def __getitem__(self, key: str) -> object:
+        if key not in self._cache:
+            if key == 'glucose':
+                self._cache[key] = {'median': self._npz['glucose_median']}
+                if 'glucose_realizations' in self._npz.files:
+                    self._cache[key]['realizations'] = self._npz['glucose_realizations']
+            elif key == 'rbg_data':
+                self._cache[key] = SimpleNamespace(t_data=self._npz['t_data'])
+            elif key in REPLAY_ARRAYS:
+                self._cache[key] = {'realizations': self._npz[key + '_realizations']}
+            else:
+                raise KeyError(key)
+        return self._cache[key]
+
+    def __iter__(self):
+        return iter(['glucose', 'rbg_data'] + REPLAY_ARRAYS)
+
+    def __len__(self) -> int:
+        return 2 + len(REPLAY_ARRAYS)
+
+    def load(self) -> dict:
+        """
+        Read all the arrays, returning replay results that do not need the file anymore.
+        """
+        return {key: self[key] for key in self}
+
+    def close(self) -> None:
+        """
+        Close the npz file (the arrays already accessed stay available).
+        """
+        self._npz.close()
+
+    def __enter__(self) -> 'ReplayWorkspace':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def load_replay(path: str) -> ReplayWorkspace:
+    """
+    Lazily load the replay results saved by save_replay (close the returned workspace when done, e.g. with a
+    with statement).
+    Args:
+        path: str, path of the npz file
+    Returns:
+        workspace: ReplayWorkspace, replay results
+    """
+    return ReplayWorkspace(path)